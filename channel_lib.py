@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+
+# GlyGen's rules, used when the config has no "channels" block
+DEFAULT_CHANNEL_RULES = [
+    {"exact": ["google"], "to": "Organic Search"},
+    {"exact": ["(direct)"], "to": "Direct"}
+]
+DEFAULT_CHANNEL = "Referral"
+
+
+
+class ChannelClassifier:
+    """
+    Buckets traffic sources into channels. Each rule matches one dimension,
+    sessionSource unless the rule names another "field" (for example
+    sessionDefaultChannelGroup), by "exact" values, by "suffix" or by a
+    "regex" matched at the start of the value, all ignoring case; the first
+    listed rule that matches wins and sources no rule matches go to the
+    default channel. Rules run over the distinct values of a column only,
+    rows pick up the result through the value's code.
+    """
+
+    def __init__(self, rules, default=DEFAULT_CHANNEL):
+        for rule in rules:
+            if not any(kind in rule for kind in ("exact", "suffix", "regex")):
+                raise ValueError("Unknown channel rule: %s" % (rule))
+        self.rules = rules
+        self.default = default
+        # Tab columns, in the order the rules name them
+        self.channels = list(dict.fromkeys([rule["to"] for rule in rules] + [default]))
+        self.fields = list(dict.fromkeys([rule.get("field", "sessionSource") for rule in rules])) or ["sessionSource"]
+
+
+    def get_mask(self, rule, values):
+        # A rule with several kinds matches a value that any of them matches
+        mask = np.zeros(len(values), dtype=bool)
+        if "exact" in rule:
+            exact_list = rule["exact"] if isinstance(rule["exact"], list) else [rule["exact"]]
+            mask |= values.isin([value.lower() for value in exact_list]).to_numpy(dtype=bool)
+        if "suffix" in rule:
+            suffix_list = rule["suffix"] if isinstance(rule["suffix"], list) else [rule["suffix"]]
+            mask |= values.str.endswith(tuple(suffix.lower() for suffix in suffix_list)).to_numpy(dtype=bool)
+        if "regex" in rule:
+            mask |= values.str.match(rule["regex"], case=False).to_numpy(dtype=bool)
+        return mask
+
+
+    def classify(self, df):
+        # Lower-cased distinct values of every field and the row codes pointing at them
+        code_dict, value_dict = {}, {}
+        for field in self.fields:
+            code_dict[field], uniques = pd.factorize(df[field])
+            value_dict[field] = pd.Series(np.asarray(uniques, dtype=object), dtype=object).astype(str).str.lower()
+
+        condition_list = []
+        for rule in self.rules:
+            field = rule.get("field", "sessionSource")
+            # A trailing False for code -1, a missing value
+            mask = np.append(self.get_mask(rule, value_dict[field]), False)
+            condition_list.append(mask[code_dict[field]])
+
+        choice_list = [self.channels.index(rule["to"]) for rule in self.rules]
+        channel_codes = np.select(condition_list, choice_list, self.channels.index(self.default)) if condition_list \
+            else np.full(len(df), self.channels.index(self.default))
+        return pd.Series(pd.Categorical.from_codes(channel_codes, categories=self.channels), index=df.index, name="channel")
+
+
+
+def get_classifier(config_obj):
+
+    channels_conf = config_obj.get("channels", {})
+    return ChannelClassifier(
+        channels_conf.get("rules", DEFAULT_CHANNEL_RULES),
+        default=channels_conf.get("default", DEFAULT_CHANNEL)
+    )
@@ -0,0 +1,42 @@
+import os
+from google.analytics.data_v1beta import BetaAnalyticsDataClient, BetaAnalyticsDataAsyncClient
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+import gspread
+import replay_lib
+import rate_lib
+import retry_lib
+
+
+
+def get_clients(domain, config_obj):
+
+    # GA4 client, Sheets service and gspread client, replayed from or recorded to fixtures if asked
+    if os.environ.get(replay_lib.REPLAY_ENV) or os.environ.get(replay_lib.RECORD_ENV):
+        replay_lib.isolate_config(config_obj)
+    if os.environ.get(replay_lib.REPLAY_ENV):
+        return replay_lib.get_replay_clients(os.environ[replay_lib.REPLAY_ENV])
+
+    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
+    credentials_file = "conf/credentials.%s.json" % (domain)
+    # Initialize the GA4 client
+    client = BetaAnalyticsDataClient()
+    scopes = ['https://www.googleapis.com/auth/spreadsheets']
+    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
+    service = build('sheets', 'v4', credentials=creds)
+    gc = gspread.authorize(creds)
+
+    # Transient GA4 errors are retried with backoff, Sheets errors by the rate limiter
+    client = retry_lib.RetryProxy(client, retry_lib.get_retrier(config_obj), async_target_factory=BetaAnalyticsDataAsyncClient)
+
+    # Sheets calls of every script run for this domain share one quota
+    limiter = rate_lib.get_limiter(domain, config_obj)
+    service = rate_lib.RateLimitProxy(service, limiter, call_names=["execute"])
+    gc = rate_lib.RateLimitProxy(gc, limiter)
+
+    if os.environ.get(replay_lib.RECORD_ENV):
+        return replay_lib.get_record_clients(
+            os.environ[replay_lib.RECORD_ENV], client, service, gc, client.get_async_client
+        )
+
+    return client, service, gc
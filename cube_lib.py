@@ -0,0 +1,233 @@
+import pandas as pd
+from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest
+import ga4_lib
+import path_lib
+import channel_lib
+import report_lib
+
+
+CUBE_START_DATE = "2020-01-01"
+
+
+
+def get_cube_requests(property_id, channel_fields=None, domain_list=None, report_list=None):
+
+    # Fine-grained monthly reports per hostname that every tab can be derived from
+    source_dims = ["year", "month", "hostname", "sessionSource", "sessionMedium"]
+    dimension_dict = {
+        "sources": source_dims + [field for field in channel_fields or [] if field not in source_dims],
+        "pages": ["year", "month", "hostname", "pagePath", "pageTitle"],
+        "countries": ["year", "month", "hostname", "country"]
+    }
+    metric_dict = {
+        "sources": ["sessions"],
+        "pages": ["screenPageViews"],
+        "countries": ["engagedSessions", "screenPageViews"]
+    }
+
+    request_dict = {}
+    for name in dimension_dict:
+        request_dict[name] = RunReportRequest(
+            property='properties/' + property_id,
+            dimensions=[Dimension(name=dim) for dim in dimension_dict[name]],
+            metrics=[Metric(name=met) for met in metric_dict[name]],
+            date_ranges=[DateRange(start_date=CUBE_START_DATE, end_date="today")],
+            limit=100000
+        )
+
+    # Unique users are not additive over months, so hostnames get their own totals
+    request_dict["hosts"] = RunReportRequest(
+        property='properties/' + property_id,
+        dimensions=[Dimension(name="hostname")],
+        metrics=[Metric(name="screenPageViews"), Metric(name="engagedSessions"), Metric(name="totalUsers")],
+        date_ranges=[DateRange(start_date="2023-04-01", end_date="today")],
+        limit=100000
+    )
+
+    # Users who visit several hostnames would be counted once per hostname, so monthly
+    # user counts come from reports over all hostnames, or over the module's when given
+    request_dict["users"] = RunReportRequest(
+        property='properties/' + property_id,
+        dimensions=[Dimension(name="year"), Dimension(name="month"), Dimension(name="newVsReturning")],
+        metrics=[Metric(name="totalUsers"), Metric(name="activeUsers"), Metric(name="eventCount"), Metric(name="sessions")],
+        date_ranges=[DateRange(start_date=CUBE_START_DATE, end_date="today")],
+        limit=100000
+    )
+    if domain_list is not None:
+        request_dict["module_users"] = RunReportRequest(
+            property='properties/' + property_id,
+            dimensions=[Dimension(name="year"), Dimension(name="month")],
+            metrics=[Metric(name=met) for met in ["totalUsers", "activeUsers", "newUsers", "eventCount", "sessions"]],
+            date_ranges=[DateRange(start_date=CUBE_START_DATE, end_date="today")],
+            dimension_filter=ga4_lib.get_in_list_filter("hostname", domain_list),
+            limit=100000
+        )
+
+    # A tab that needs only some of the reports leaves the others unrequested
+    if report_list is not None:
+        request_dict = {name: request for name, request in request_dict.items() if name in report_list}
+
+    return request_dict
+
+
+def build_cube(collector, config_obj, domain_list=None, report_list=None):
+
+    # Channel rules may classify on more than sessionSource; domain_list adds the module's users
+    # and report_list names the reports to build, all of them when None
+    channel_fields = channel_lib.get_classifier(config_obj).fields
+    for name, request in get_cube_requests(config_obj["property_id"], channel_fields, domain_list, report_list).items():
+        collector.add(name, request, paginate=True)
+    responses = collector.run()
+
+    cube = {name: ga4_lib.decode_response(response) for name, response in responses.items()}
+
+    # Monthly reports are grouped, joined and sorted by integer period keys
+    for df in cube.values():
+        if "year" in df.columns:
+            df["Month-Year"] = ga4_lib.get_month_keys(df)
+
+    return cube
+
+
+def filter_cube(df, domain_list=None, start_date=None):
+
+    if domain_list is not None:
+        df = df[df["hostname"].isin(domain_list)]
+    if start_date is not None:
+        df = df[df["Month-Year"] >= ga4_lib.get_period(pd.Timestamp(start_date))]
+
+    return df
+
+
+def get_traffic_sources(cube, classifier, domain_list=None):
+
+    df = filter_cube(cube["sources"], domain_list, CUBE_START_DATE)
+    df = df.assign(channel=classifier.classify(df))
+
+    return report_lib.get_month_table(df, "channel", "sessions", classifier.channels, dtype=float).reset_index()
+
+
+def derive_alldomains_data(cube, classifier=None):
+
+    if classifier is None:
+        classifier = channel_lib.ChannelClassifier(channel_lib.DEFAULT_CHANNEL_RULES)
+
+    df = filter_cube(cube["users"], start_date=CUBE_START_DATE)
+    main_df = df.groupby("Month-Year")[["activeUsers", "eventCount", "sessions"]].sum().astype(float)
+    user_type_df = report_lib.get_month_table(df, "newVsReturning", "totalUsers", ["new", "returning"], main_df.index, dtype=float)
+    main_df["New Users"] = user_type_df["new"]
+    main_df["Returning Users"] = user_type_df["returning"]
+    main_df["Total Users"] = main_df["New Users"] + main_df["Returning Users"]
+    main_df = main_df.rename(columns={"activeUsers": "Users/Active Users", "eventCount": "Hits/Events", "sessions": "Sessions"})
+
+    combined_df = pd.merge(main_df.reset_index(), get_traffic_sources(cube, classifier), on="Month-Year", how='left')
+    columns_order = [
+        'Month-Year', 'Total Users', 'Users/Active Users',
+        'New Users', 'Returning Users', 'Hits/Events', 'Sessions'
+    ] + classifier.channels
+
+    return ga4_lib.sort_by_month(combined_df[columns_order])
+
+
+def derive_overview(cube, domain_list, classifier=None):
+
+    if classifier is None:
+        classifier = channel_lib.ChannelClassifier(channel_lib.DEFAULT_CHANNEL_RULES)
+
+    # cube needs the module_users report of build_cube(..., domain_list)
+    df = filter_cube(cube["module_users"], start_date=CUBE_START_DATE)
+    main_df = df.groupby("Month-Year")[["totalUsers", "activeUsers", "newUsers", "eventCount", "sessions"]].sum().astype(float)
+    main_df["Returning Users"] = main_df["totalUsers"] - main_df["newUsers"]
+    main_df = main_df.rename(columns={
+        "totalUsers": "Total Users", "activeUsers": "Users/Active Users", "newUsers": "New Users",
+        "eventCount": "Hits/Events", "sessions": "Sessions"
+    })
+
+    combined_df = pd.merge(main_df.reset_index(), get_traffic_sources(cube, classifier, domain_list), on="Month-Year", how='left')
+    columns_order = [
+        'Month-Year', 'Total Users', 'Users/Active Users', 'Returning Users',
+        'New Users', 'Hits/Events', 'Sessions'
+    ] + classifier.channels
+
+    return ga4_lib.sort_by_month(combined_df[columns_order])
+
+
+def derive_top_referrals(cube, start_date, domain_list=None, n=10):
+
+    df = filter_cube(cube["sources"], domain_list, start_date)
+    referral_df = df[df["sessionMedium"] == "referral"]
+    ranking = referral_df.groupby("sessionSource", observed=True)["sessions"].sum().sort_values(ascending=False)
+    top_sources = ranking.index[:n].tolist()
+
+    monthly = report_lib.get_month_table(df, "sessionSource", "sessions", top_sources, ga4_lib.get_calendar_periods(start_date))
+
+    return report_lib.drop_empty_months(report_lib.format_matrix(monthly))
+
+
+def derive_bottom_pages(cube, start_date, domain_list=None, n=10):
+
+    df = filter_cube(cube["pages"], domain_list, start_date)
+    ranking = df.groupby(["pagePath", "pageTitle"], observed=True)["screenPageViews"].sum().sort_values(ascending=True)
+    bottom_pages = ranking.index[:n].tolist()
+    bottom_paths = list(dict.fromkeys(path for path, title in bottom_pages))
+
+    monthly = report_lib.get_month_table(df, "pagePath", "screenPageViews", bottom_paths, ga4_lib.get_calendar_periods(start_date))
+
+    return report_lib.label_pages(report_lib.format_matrix(monthly), bottom_pages)
+
+
+def derive_top_countries(cube, start_date, domain_list=None, n=10):
+
+    df = filter_cube(cube["countries"], domain_list, start_date)
+    ranking = df.groupby("country", observed=True)["screenPageViews"].sum().sort_values(ascending=False)[:n]
+
+    return pd.DataFrame({"Country": ranking.index.tolist(), "Pageviews": ranking.values.astype(int)})
+
+
+def derive_top_countries_monthly(cube, start_date, domain_list=None, n=10):
+
+    df = filter_cube(cube["countries"], domain_list, start_date)
+    ranking = df.groupby("country", observed=True)["engagedSessions"].sum().sort_values(ascending=False)
+    top_countries = ranking.index[:n].tolist()
+
+    monthly = report_lib.get_month_table(df, "country", "engagedSessions", top_countries)
+    monthly.insert(0, 'Total Engaged Sessions', monthly.sum(axis=1))
+
+    return report_lib.format_matrix(monthly)
+
+
+def derive_top_pages(cube, start_date, domain_list=None, n=20, total_first=True, normalizer=None):
+
+    if normalizer is None:
+        normalizer = path_lib.PathNormalizer(path_lib.DEFAULT_PATH_RULES)
+    df = filter_cube(cube["pages"], domain_list, start_date)
+    df = df.assign(normalized_path=normalizer.normalize_column(df["pagePath"]))
+
+    # Rank normalized paths, labelling each with its most viewed raw path
+    path_views = df.groupby(["normalized_path", "pagePath"], observed=True)["screenPageViews"].sum().sort_values(ascending=False)
+    path_views = path_views.reset_index().drop_duplicates("normalized_path")
+    ranking = df.groupby("normalized_path", observed=True)["screenPageViews"].sum().sort_values(ascending=False)
+    top_paths = ranking.index[:n].tolist()
+    label_dict = dict(zip(path_views["normalized_path"], path_views["pagePath"]))
+
+    total = df.groupby("Month-Year")["screenPageViews"].sum()
+    monthly = report_lib.get_month_table(df, "normalized_path", "screenPageViews", top_paths, total.index)
+    monthly = monthly.rename(columns=label_dict)
+    if total_first:
+        monthly.insert(0, 'Total Pageviews', total.astype(int))
+    else:
+        monthly['Total Pageviews'] = total.astype(int)
+
+    return report_lib.format_matrix(monthly)
+
+
+def derive_subdomains_overview(cube):
+
+    df = cube["hosts"].sort_values("screenPageViews", ascending=False)
+    df = df.rename(columns={
+        "hostname": "Hostname", "screenPageViews": "Pageviews",
+        "engagedSessions": "Engaged Sessions", "totalUsers": "Users"
+    })
+    df = df[["Hostname", "Pageviews", "Engaged Sessions", "Users"]].astype({"Pageviews": int, "Engaged Sessions": int, "Users": int})
+
+    return df.reset_index(drop=True)
@@ -0,0 +1,669 @@
+import os
+import time
+import json
+import hashlib
+import uuid
+import sqlite3
+import datetime
+import asyncio
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import replay_lib
+from google.analytics.data_v1beta import BetaAnalyticsDataAsyncClient
+from google.analytics.data_v1beta.types import BatchRunReportsRequest, RunReportRequest, RunReportResponse
+from google.analytics.data_v1beta.types import BatchRunPivotReportsRequest, RunPivotReportRequest, RunPivotReportResponse
+from google.analytics.data_v1beta.types import Filter, FilterExpression, FilterExpressionList, MetricType
+
+
+# batchRunReports accepts at most five requests per call
+MAX_BATCH_SIZE = 5
+
+# Batch method, batch request type, response field and response type per request type
+BATCH_METHODS = {
+    RunReportRequest: ("batch_run_reports", BatchRunReportsRequest, "reports", RunReportResponse),
+    RunPivotReportRequest: ("batch_run_pivot_reports", BatchRunPivotReportsRequest, "pivot_reports", RunPivotReportResponse)
+}
+
+# Dimensions whose string values are numbers
+INTEGER_DIMENSIONS = ["year", "month", "week", "day", "hour", "yearMonth"]
+
+
+
+class ReportCollector:
+    """
+    Collects RunReportRequests and RunPivotReportRequests and sends them to
+    GA4 through batch_run_reports and batch_run_pivot_reports. Requests of the
+    same type and property are grouped into batches of at most MAX_BATCH_SIZE,
+    and every caller gets back its own response by key.
+    With concurrency > 1 the batches of a round are sent concurrently
+    through BetaAnalyticsDataAsyncClient, at most concurrency at a time;
+    a smaller batch_size spreads the requests over more concurrent calls.
+    When a ReportCache is given it is consulted before anything is sent,
+    and with a MonthStore monthly reports only ask GA4 for open months.
+    With a retry_lib.Checkpoint, responses an earlier failed run of the
+    same day fetched are reused and every new response is added to it;
+    monthly reports then ask GA4 for the months the failed run asked for.
+    iter_report() streams a long report as decoded chunks instead.
+    """
+
+    def __init__(self, client, concurrency=1, batch_size=MAX_BATCH_SIZE, cache=None, month_store=None, checkpoint=None):
+        self.client = client
+        self.concurrency = concurrency
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.cache = cache
+        self.month_store = month_store
+        self.checkpoint = checkpoint
+        self.pending = []
+
+
+    def add(self, key, request, paginate=False):
+        # paginate=True keeps requesting pages until row_count rows are fetched
+        self.pending.append((key, request, paginate))
+        return key
+
+
+    def run(self):
+        pending, self.pending = self.pending, []
+
+        # Monthly reports only request the months that can still change
+        plan_dict = {}
+        if self.month_store is not None:
+            for i, (key, request, paginate) in enumerate(pending):
+                plan = self.get_plan(request)
+                if plan is not None:
+                    plan_dict[key] = plan
+                    pending[i] = (key, plan["request"], paginate)
+
+        responses = self.fetch(pending)
+        for key, plan in plan_dict.items():
+            responses[key] = self.month_store.merge(plan, responses[key])
+
+        return responses
+
+
+    def get_plan(self, request):
+        # A rerun asks GA4 for the same months as the failed run, so the responses
+        # the checkpoint holds for those requests still match
+        if self.checkpoint is None:
+            return self.month_store.get_plan(request)
+        request_key = get_request_key(request)
+        plan = self.month_store.get_plan(request, self.checkpoint.get_period(request_key))
+        if plan is not None:
+            self.checkpoint.put_period(request_key, plan["fetch_period"])
+        return plan
+
+
+    def fetch(self, pending):
+        responses = {}
+
+        # Answer what we can from the checkpoint and the local cache
+        fetch_list = []
+        for key, request, paginate in pending:
+            response = self.get_stored(request)
+            if response is not None:
+                responses[key] = response
+            else:
+                fetch_list.append((key, request, paginate))
+        pending = fetch_list
+
+        batch_list = get_batches([(key, request) for key, request, paginate in pending], self.batch_size)
+        for batch, batch_responses in zip(batch_list, self.send_batches(batch_list)):
+            for (key, request), response in zip(batch, batch_responses):
+                responses[key] = response
+
+        # Fetch the remaining pages of truncated responses in one more round
+        page_list = []
+        for key, request, paginate in pending:
+            if paginate:
+                page_list += get_page_requests(key, request, responses[key])
+        batch_list = get_batches(page_list, self.batch_size)
+        for batch, batch_responses in zip(batch_list, self.send_batches(batch_list)):
+            for ((key, offset), request), response in zip(batch, batch_responses):
+                responses[key].rows.extend(response.rows)
+
+        for key, request, paginate in pending:
+            for store in (self.checkpoint, self.cache):
+                if store is not None:
+                    store.put(get_request_key(request), responses[key])
+
+        return responses
+
+
+    def get_stored(self, request):
+        response_type = BATCH_METHODS[type(request)][3]
+        for store in (self.checkpoint, self.cache):
+            if store is not None:
+                response = store.get(get_request_key(request), response_type)
+                if response is not None:
+                    return response
+        return None
+
+
+    def run_report(self, request, paginate=False):
+        self.add("report", request, paginate)
+        return self.run()["report"]
+
+
+    def iter_report(self, request):
+        # Yields decode_response() chunks of request, one per page of request.limit rows.
+        # After the first page, up to concurrency pages are fetched ahead in threads.
+        plan = self.get_plan(request) if self.month_store is not None else None
+        if plan is not None:
+            request = plan["request"]
+        page_size = request.limit or 10000
+        first_request = copy_request(request, offset=0, limit=page_size)
+
+        response = self.get_stored(first_request)
+        if response is None:
+            response = self.client.run_report(first_request)
+            if self.checkpoint is not None:
+                self.checkpoint.put(get_request_key(first_request), response)
+            # Only complete responses are kept, longer ones are never held in memory
+            if len(response.rows) >= response.row_count and self.cache is not None:
+                self.cache.put(get_request_key(first_request), response)
+        yield self.decode_page(plan, response, 0)
+
+        offset_list = list(range(page_size, response.row_count, page_size))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(self.concurrency, 1)) as executor:
+            future_list = []
+            for offset in offset_list:
+                page_request = copy_request(request, offset=offset, limit=page_size)
+                future_list.append((page_request, self.submit_page(executor, page_request)))
+                if len(future_list) > self.concurrency:
+                    yield self.get_page(plan, *future_list.pop(0))
+            for page_request, future in future_list:
+                yield self.get_page(plan, page_request, future)
+
+        if plan is not None:
+            # Every page is in, so the closed months they held can be kept
+            self.month_store.finish_save(plan)
+
+            # Closed months that were not requested again come last
+            for stored_response in self.month_store.get_stored(plan):
+                stored_response = RunReportResponse(
+                    dimension_headers=response.dimension_headers, metric_headers=response.metric_headers,
+                    rows=stored_response.rows
+                )
+                yield decode_response(stored_response)
+
+
+    def submit_page(self, executor, page_request):
+        # Pages the checkpoint holds are not requested again
+        response = self.checkpoint.get(get_request_key(page_request), RunReportResponse) if self.checkpoint is not None else None
+        if response is None:
+            return executor.submit(self.client.run_report, page_request)
+        future = concurrent.futures.Future()
+        future.set_result(response)
+        return future
+
+
+    def get_page(self, plan, page_request, future):
+        # The checkpoint and the month store are only written from the calling thread
+        response = future.result()
+        if self.checkpoint is not None:
+            self.checkpoint.put(get_request_key(page_request), response)
+        return self.decode_page(plan, response, page_request.offset)
+
+
+    def decode_page(self, plan, response, offset):
+        # Closed months of each page are saved as it passes, so no page is held on to
+        if plan is not None:
+            self.month_store.save_page(plan, response, offset)
+        return decode_response(response)
+
+
+    def send_batches(self, batch_list):
+        if self.concurrency > 1 and len(batch_list) > 1:
+            return asyncio.run(self.send_batches_async(batch_list))
+        batch_responses = []
+        for batch in batch_list:
+            method_name, batch_type, field_name, response_type = BATCH_METHODS[type(batch[0][1])]
+            batch_responses.append(getattr(getattr(self.client, method_name)(get_batch_request(batch)), field_name))
+        return batch_responses
+
+
+    def get_async_client(self):
+        # Record/replay stand-ins bring their own async client
+        if hasattr(self.client, "get_async_client"):
+            return self.client.get_async_client()
+        return BetaAnalyticsDataAsyncClient()
+
+
+    async def send_batches_async(self, batch_list):
+        async_client = self.get_async_client()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_batch(batch):
+            method_name, batch_type, field_name, response_type = BATCH_METHODS[type(batch[0][1])]
+            async with semaphore:
+                response = await getattr(async_client, method_name)(get_batch_request(batch))
+                return getattr(response, field_name)
+
+        try:
+            return await asyncio.gather(*[send_batch(batch) for batch in batch_list])
+        finally:
+            await async_client.transport.close()
+
+
+
+class ReportCache:
+    """
+    Disk cache of GA4 responses in a SQLite file under cache_dir, keyed by
+    get_request_key(). Entries older than ttl_hours are not used, and the
+    least recently used entries are evicted once the file holds more than
+    max_mb of responses.
+    """
+
+    def __init__(self, cache_dir, ttl_hours=12, max_mb=500):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = max_mb * 1024 * 1024
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "reports.sqlite"), timeout=60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS reports "
+            "(key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, data BLOB)"
+        )
+        self.conn.commit()
+
+
+    def get(self, key, response_type=RunReportResponse):
+        row = self.conn.execute(
+            "SELECT data FROM reports WHERE key = ? AND created > ?", (key, time.time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE reports SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return response_type.deserialize(row[0])
+
+
+    def put(self, key, response):
+        data = type(response).serialize(response)
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?)", (key, now, now, len(data), data)
+        )
+        self.evict()
+        self.conn.commit()
+
+
+    def evict(self):
+        self.conn.execute("DELETE FROM reports WHERE created <= ?", (time.time() - self.ttl,))
+        total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM reports").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM reports ORDER BY accessed").fetchall():
+            if total_size <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM reports WHERE key = ?", (key,))
+            total_size -= size
+
+
+
+class MonthStore:
+    """
+    Keeps the rows of closed months of monthly reports (requests with year
+    and month dimensions) in a SQLite file under cache_dir, so GA4 is only
+    asked for the months that can still change. A month is closed once
+    settle_days have passed since its last day; months that closed since
+    the last run are requested once more and then kept as well.
+    Long reports are saved page by page as they arrive; their rows only
+    replace the stored ones once the last page is in (finish_save).
+    """
+
+    def __init__(self, cache_dir, settle_days=3):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.settle_days = settle_days
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "months.sqlite"), timeout=60)
+        # Rows of a month may come from several pages, run is '' once they are complete
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS month_rows "
+            "(key TEXT, period INTEGER, part INTEGER, run TEXT, data BLOB, PRIMARY KEY (key, period, part, run))"
+        )
+        self.conn.commit()
+
+
+    def get_plan(self, request, fetch_from=None):
+        # fetch_from, the first month an earlier run asked for, is the latest one GA4 is asked from
+        if not isinstance(request, RunReportRequest):
+            return None
+        dim_names = [dimension.name for dimension in request.dimensions]
+        if "year" not in dim_names or "month" not in dim_names:
+            return None
+        if len(request.date_ranges) != 1 or request.offset != 0:
+            return None
+
+        date_range = request.date_ranges[0]
+        start_date = datetime.date.fromisoformat(resolve_date(date_range.start_date))
+        end_date = datetime.date.fromisoformat(resolve_date(date_range.end_date))
+        settled_date = get_today() - datetime.timedelta(days=self.settle_days)
+        first_open_period = get_period(settled_date + datetime.timedelta(days=1))
+        if first_open_period <= get_period(start_date) or first_open_period > get_period(end_date):
+            return None
+
+        # Stored months do not depend on the end date, limit or offset
+        history_request = copy_request(
+            request, limit=0, offset=0,
+            date_ranges=[{"start_date": start_date.isoformat(), "end_date": ""}]
+        )
+
+        # "stored" months are read back, "closed" ones are kept from the response
+        start_period = get_period(start_date)
+        plan = {
+            "key": get_request_key(history_request),
+            "stored": [],
+            "closed": list(range(start_period, first_open_period)),
+            "request": request,
+            "run": uuid.uuid4().hex
+        }
+
+        # Pages a failed run left behind are dropped, GA4 is asked for
+        # everything from the first closed month the store is missing
+        self.conn.execute("DELETE FROM month_rows WHERE key = ? AND run != ''", (plan["key"],))
+        self.conn.commit()
+        stored_periods = set(period for (period,) in self.conn.execute(
+            "SELECT DISTINCT period FROM month_rows WHERE key = ? AND run = ''", (plan["key"],)
+        ))
+        fetch_period = start_period
+        while fetch_period < first_open_period and fetch_period in stored_periods:
+            fetch_period += 1
+        if fetch_from is not None:
+            fetch_period = max(start_period, min(fetch_period, fetch_from))
+        plan["fetch_period"] = fetch_period
+        if fetch_period > start_period:
+            fetch_start = "%04d-%02d-01" % (fetch_period // 12, fetch_period % 12 + 1)
+            plan["request"] = copy_request(
+                request, date_ranges=[{"start_date": fetch_start, "end_date": date_range.end_date}]
+            )
+            plan["stored"] = list(range(start_period, fetch_period))
+            plan["closed"] = list(range(fetch_period, first_open_period))
+
+        return plan
+
+
+    def merge(self, plan, response):
+        # Months that closed since the last run are kept for the next one
+        self.save(plan, response)
+        if not plan["stored"]:
+            return response
+
+        rows = list(response.rows)
+        for stored_response in self.get_stored(plan):
+            rows += stored_response.rows
+
+        return RunReportResponse(
+            dimension_headers=response.dimension_headers,
+            metric_headers=response.metric_headers,
+            metadata=response.metadata,
+            rows=rows,
+            row_count=len(rows)
+        )
+
+
+    def get_stored(self, plan):
+        # One response per month and page it was saved from, latest month first
+        if not plan["stored"]:
+            return
+        for (data,) in self.conn.execute(
+            "SELECT data FROM month_rows WHERE key = ? AND run = '' AND period BETWEEN ? AND ? ORDER BY period DESC, part",
+            (plan["key"], plan["stored"][0], plan["stored"][-1])
+        ).fetchall():
+            yield RunReportResponse.deserialize(data)
+
+
+    def save(self, plan, response):
+        # A response cut short by its limit may be missing rows of any month
+        if not plan["closed"] or len(response.rows) < response.row_count:
+            return
+        self.save_page(plan, response, 0)
+        self.finish_save(plan)
+
+
+    def save_page(self, plan, response, part):
+        # Rows of closed months in one page, kept aside until finish_save
+        if not plan["closed"]:
+            return
+
+        dim_names = [header.name for header in response.dimension_headers]
+        year_idx, month_idx = dim_names.index("year"), dim_names.index("month")
+        period_rows = {period: [] for period in plan["closed"]}
+        for row in response.rows:
+            year = int(row.dimension_values[year_idx].value)
+            month = int(row.dimension_values[month_idx].value)
+            if year * 12 + month - 1 in period_rows:
+                period_rows[year * 12 + month - 1].append(row)
+
+        for period, rows in period_rows.items():
+            if rows:
+                data = RunReportResponse.serialize(RunReportResponse(rows=rows))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO month_rows VALUES (?, ?, ?, ?, ?)", (plan["key"], period, part, plan["run"], data)
+                )
+        self.conn.commit()
+
+
+    def finish_save(self, plan):
+        # Every page is in: the run's rows replace the stored ones, months without rows get an empty part
+        if not plan["closed"]:
+            return
+
+        self.conn.execute(
+            "DELETE FROM month_rows WHERE key = ? AND run = '' AND period BETWEEN ? AND ?",
+            (plan["key"], plan["closed"][0], plan["closed"][-1])
+        )
+        empty_data = RunReportResponse.serialize(RunReportResponse())
+        for period in plan["closed"]:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO month_rows VALUES (?, ?, ?, ?, ?)", (plan["key"], period, -1, plan["run"], empty_data)
+            )
+        self.conn.execute("UPDATE month_rows SET run = '' WHERE key = ? AND run = ?", (plan["key"], plan["run"]))
+        self.conn.commit()
+
+
+
+def decode_response(response):
+
+    # Read the values straight off the protobuf rows, one list per column
+    response_pb = type(response).pb(response)
+    dim_names = [header.name for header in response_pb.dimension_headers]
+    met_headers = [(header.name, header.type_) for header in response_pb.metric_headers]
+    dim_rows = [[value.value for value in row.dimension_values] for row in response_pb.rows]
+    met_rows = [[value.value for value in row.metric_values] for row in response_pb.rows]
+    dim_columns = list(zip(*dim_rows)) if dim_rows else [[] for name in dim_names]
+    met_columns = list(zip(*met_rows)) if met_rows else [[] for header in met_headers]
+
+    columns = {}
+    for dim_name, values in zip(dim_names, dim_columns):
+        if dim_name in INTEGER_DIMENSIONS:
+            columns[dim_name] = np.array(values, dtype=np.int64)
+        else:
+            columns[dim_name] = pd.Categorical(values)
+    for (met_name, met_type), values in zip(met_headers, met_columns):
+        dtype = np.int64 if met_type == MetricType.TYPE_INTEGER else np.float64
+        columns[met_name] = np.array(values, dtype=dtype)
+
+    return pd.DataFrame(columns, columns=dim_names + [met_name for met_name, met_type in met_headers])
+
+
+def get_month_keys(df):
+
+    # Integer period keys (see get_period) from the year and month columns
+    return df["year"].astype(int) * 12 + df["month"].astype(int) - 1
+
+
+def get_calendar_periods(start_date):
+
+    # Period keys of the months from start_date whose last day has been reached,
+    # as pd.date_range(..., freq='M') gives them
+    now = pd.Timestamp(get_today())
+    last_period = get_period(now) if now.is_month_end else get_period(now) - 1
+    return list(range(get_period(pd.Timestamp(start_date)), last_period + 1))
+
+
+def sort_by_month(df):
+
+    # Latest month first; the "Month-Year" period keys only become labels when written
+    return df.sort_values('Month-Year', ascending=False).reset_index(drop=True)
+
+
+def copy_request(request, **fields):
+
+    # Passing fields to the constructor would merge repeated fields, so assign them
+    request_copy = type(request)(request)
+    for field_name, value in fields.items():
+        setattr(request_copy, field_name, value)
+
+    return request_copy
+
+
+def get_dimension_values(response, dim_name):
+
+    # Distinct values of one dimension, in the order the rows came back
+    dim_idx = [header.name for header in response.dimension_headers].index(dim_name)
+    return list(dict.fromkeys(row.dimension_values[dim_idx].value for row in response.rows))
+
+
+def get_in_list_filter(field_name, value_list):
+
+    # GA4 rejects an in-list filter without values
+    if len(value_list) == 0:
+        raise ValueError("No values to filter %s on" % (field_name))
+
+    return FilterExpression(
+        filter=Filter(field_name=field_name, in_list_filter=Filter.InListFilter(values=value_list))
+    )
+
+
+def get_string_filter(field_name, value, match_type="EXACT"):
+
+    return FilterExpression(
+        filter=Filter(field_name=field_name, string_filter=Filter.StringFilter(value=value, match_type=match_type))
+    )
+
+
+def get_and_filter(expression_list):
+
+    expression_list = [expression for expression in expression_list if expression is not None]
+    if len(expression_list) == 1:
+        return expression_list[0]
+
+    return FilterExpression(and_group=FilterExpressionList(expressions=expression_list))
+
+
+def get_or_filter(expression_list):
+
+    # GA4 rejects an or-group without expressions
+    if len(expression_list) == 0:
+        raise ValueError("No expressions to combine")
+    if len(expression_list) == 1:
+        return expression_list[0]
+
+    return FilterExpression(or_group=FilterExpressionList(expressions=expression_list))
+
+
+def get_period(date):
+
+    return date.year * 12 + date.month - 1
+
+
+def get_request_key(request):
+
+    # Relative dates are resolved so that "today" keys roll over every day
+    request_obj = json.loads(type(request).to_json(request))
+    for date_range in request_obj.get("dateRanges", []):
+        date_range["startDate"] = resolve_date(date_range["startDate"])
+        date_range["endDate"] = resolve_date(date_range["endDate"])
+
+    request_str = type(request).__name__ + json.dumps(request_obj, sort_keys=True)
+    return hashlib.sha256(request_str.encode("utf-8")).hexdigest()
+
+
+def get_today():
+
+    # A replayed run sees the day its fixtures were recorded on
+    return replay_lib.get_recorded_date() or datetime.date.today()
+
+
+def resolve_date(date_str):
+
+    today = get_today()
+    if date_str == "today":
+        return today.isoformat()
+    if date_str == "yesterday":
+        return (today - datetime.timedelta(days=1)).isoformat()
+    if date_str.endswith("daysAgo"):
+        return (today - datetime.timedelta(days=int(date_str[:-7]))).isoformat()
+
+    return date_str
+
+
+def get_batches(request_list, batch_size=MAX_BATCH_SIZE):
+
+    # Group (key, request) pairs by property and type, preserving the order they were added
+    property_dict = {}
+    for key, request in request_list:
+        property_dict.setdefault((request.property, type(request)), []).append((key, request))
+
+    batch_list = []
+    for property_requests in property_dict.values():
+        for i in range(0, len(property_requests), batch_size):
+            batch_list.append(property_requests[i:i + batch_size])
+
+    return batch_list
+
+
+def get_batch_request(batch):
+
+    batch_type = BATCH_METHODS[type(batch[0][1])][1]
+    return batch_type(
+        property=batch[0][1].property,
+        requests=[request for key, request in batch]
+    )
+
+
+def get_page_requests(key, request, response):
+
+    # Pivot reports are limited per pivot and come back whole
+    if not isinstance(request, RunReportRequest):
+        return []
+
+    page_size = len(response.rows)
+    if page_size == 0 or response.row_count <= request.offset + page_size:
+        return []
+
+    page_list = []
+    for offset in range(request.offset + page_size, response.row_count, page_size):
+        page_request = copy_request(request, offset=offset, limit=page_size)
+        page_list.append(((key, offset), page_request))
+
+    return page_list
+
+
+def get_collector(client, config_obj, checkpoint=None):
+
+    ga4_conf = config_obj.get("ga4", {})
+
+    cache = None
+    if ga4_conf.get("cache_dir"):
+        cache = ReportCache(
+            ga4_conf["cache_dir"],
+            ttl_hours=ga4_conf.get("cache_ttl_hours", 12),
+            max_mb=ga4_conf.get("cache_max_mb", 500)
+        )
+
+    month_store = None
+    if ga4_conf.get("incremental"):
+        month_store = MonthStore(
+            ga4_conf.get("cache_dir", "cache"),
+            settle_days=ga4_conf.get("settle_days", 3)
+        )
+
+    return ReportCollector(
+        client,
+        concurrency=ga4_conf.get("concurrency", 1),
+        batch_size=ga4_conf.get("batch_size", MAX_BATCH_SIZE),
+        cache=cache,
+        month_store=month_store,
+        checkpoint=checkpoint
+    )
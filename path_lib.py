@@ -0,0 +1,129 @@
+import re
+import numpy as np
+import pandas as pd
+import ga4_lib
+
+
+# GlyGen's rules, used when the config has no "page_paths" block
+DEFAULT_PATH_RULES = [
+    {"exact": ["/", "/home", "/home/"], "to": "/"},
+    {"prefix": "/glycan-search", "to": "/glycan-search/"},
+    {"prefix": "/protein-search", "to": "/protein-search/"}
+]
+
+
+
+class PathNormalizer:
+    """
+    Maps raw pagePath values to the path their views are counted under.
+    Rules are tried by kind: exact paths first (a dict lookup), then
+    prefixes (a trie, the longest matching prefix wins), then regular
+    expressions (one combined pattern matched at the start of the path,
+    the first listed rule wins). Paths no rule matches lose their trailing
+    slash with trailing_slash "strip", gain one with "add", or stay as they
+    are with "keep". Every distinct path is normalized once and remembered.
+    """
+
+    def __init__(self, rules, trailing_slash="strip"):
+        self.exact_dict = {}
+        self.prefix_list = []
+        self.trie = {}
+        self.trailing_slash = trailing_slash
+        self.memo = {}
+
+        pattern_list, self.regex_targets = [], {}
+        group_idx = 1
+        for rule in rules:
+            if "exact" in rule:
+                paths = rule["exact"] if isinstance(rule["exact"], list) else [rule["exact"]]
+                for path in paths:
+                    self.exact_dict.setdefault(path, rule["to"])
+            elif "prefix" in rule:
+                self.prefix_list.append((rule["prefix"], rule["to"]))
+                self.add_prefix(rule["prefix"], rule["to"])
+            elif "regex" in rule:
+                # Each rule is one outer group; lastindex names the rule that matched
+                self.regex_targets[group_idx] = rule["to"]
+                pattern_list.append("(%s)" % (rule["regex"]))
+                group_idx += 1 + re.compile(rule["regex"]).groups
+            else:
+                raise ValueError("Unknown path rule: %s" % (rule))
+        self.regex = re.compile("|".join(pattern_list)) if pattern_list else None
+
+
+    def add_prefix(self, prefix, target):
+        node = self.trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # None cannot clash with a character key
+        node.setdefault(None, target)
+
+
+    def match_prefix(self, path):
+        node, target = self.trie, None
+        for char in path:
+            if None in node:
+                target = node[None]
+            node = node.get(char)
+            if node is None:
+                return target
+        return node.get(None, target)
+
+
+    def normalize(self, path):
+        target = self.memo.get(path)
+        if target is None:
+            target = self.memo[path] = self.match(path)
+        return target
+
+
+    def match(self, path):
+        if path in self.exact_dict:
+            return self.exact_dict[path]
+        target = self.match_prefix(path)
+        if target is not None:
+            return target
+        if self.regex is not None:
+            match = self.regex.match(path)
+            if match is not None:
+                return self.regex_targets[match.lastindex]
+
+        if self.trailing_slash == "strip":
+            return path.rstrip("/") or "/"
+        if self.trailing_slash == "add" and not path.endswith("/"):
+            return path + "/"
+        return path
+
+
+    def normalize_column(self, paths):
+        # Rules run once per distinct path, the result is spread back by position
+        codes, uniques = pd.factorize(paths)
+        targets = np.array([self.normalize(str(path)) for path in uniques], dtype=object)
+        return pd.Series(targets[codes], index=paths.index, name=paths.name)
+
+
+    def get_filter(self, path_list, key_list):
+        # pagePath filter for every raw path counted under key_list, with prefix rules sent as such
+        key_set = set(key_list)
+        prefix_tuple = tuple(prefix for prefix, target in self.prefix_list if target in key_set)
+        raw_paths = [path for path, target in self.exact_dict.items() if target in key_set]
+        raw_paths += [path for path in dict.fromkeys(path_list) if self.normalize(path) in key_set]
+        raw_paths = [path for path in dict.fromkeys(raw_paths) if not path.startswith(prefix_tuple)]
+
+        expression_list = [ga4_lib.get_string_filter("pagePath", prefix, "BEGINS_WITH") for prefix in prefix_tuple]
+        if raw_paths:
+            expression_list.insert(0, ga4_lib.get_in_list_filter("pagePath", raw_paths))
+        # None when no path is counted under key_list, there is nothing to request then
+        if not expression_list:
+            return None
+        return ga4_lib.get_or_filter(expression_list)
+
+
+
+def get_normalizer(config_obj):
+
+    paths_conf = config_obj.get("page_paths", {})
+    return PathNormalizer(
+        paths_conf.get("rules", DEFAULT_PATH_RULES),
+        trailing_slash=paths_conf.get("trailing_slash", "strip")
+    )
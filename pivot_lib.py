@@ -0,0 +1,74 @@
+from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, OrderBy, Pivot, RunPivotReportRequest
+import ga4_lib
+import report_lib
+
+
+# Upper bound on the number of months in the month pivot
+MAX_MONTHS = 1000
+
+
+
+def get_monthly_pivot_request(property_id, key_dim, metric_name, start_date, key_limit=10, desc=True, dimension_filter=None):
+
+    # Months as one pivot and the top key_limit values of key_dim, ranked by metric_name, as the other
+    if key_limit < 1:
+        raise ValueError("Pivot on %s needs a limit of at least 1" % (key_dim))
+    return RunPivotReportRequest(
+        property='properties/' + property_id,
+        dimensions=[Dimension(name="year"), Dimension(name="month"), Dimension(name=key_dim)],
+        metrics=[Metric(name=metric_name)],
+        date_ranges=[DateRange(start_date=start_date, end_date="today")],
+        dimension_filter=dimension_filter,
+        pivots=[
+            Pivot(
+                field_names=["year", "month"],
+                order_bys=[
+                    OrderBy(dimension={"dimension_name": "year"}, desc=True),
+                    OrderBy(dimension={"dimension_name": "month"}, desc=True)
+                ],
+                limit=MAX_MONTHS
+            ),
+            Pivot(
+                field_names=[key_dim],
+                order_bys=[OrderBy(metric={"metric_name": metric_name}, desc=desc)],
+                limit=key_limit
+            )
+        ]
+    )
+
+
+def get_pivot_matrix(response, key_list=None, month_list=None):
+
+    # Month x key matrix with keys in the order of the key pivot unless key_list is given
+    if key_list is None:
+        key_list = [header.dimension_values[0].value for header in response.pivot_headers[1].pivot_dimension_headers]
+    df = ga4_lib.decode_response(response)
+    # A pivot that was not requested for want of keys has no columns
+    key_dim, metric_name = (df.columns[2], df.columns[3]) if len(df.columns) else (None, None)
+
+    return report_lib.get_month_table(df, key_dim, metric_name, key_list, month_list)
+
+
+def derive_top_countries_monthly(response):
+
+    matrix = get_pivot_matrix(response)
+    matrix.insert(0, 'Total Engaged Sessions', matrix.sum(axis=1))
+
+    return report_lib.format_matrix(matrix)
+
+
+def derive_top_referrals(response, start_date, key_list):
+
+    # Keys come from the first pass, which ranks referral sessions only
+    matrix = get_pivot_matrix(response, key_list, ga4_lib.get_calendar_periods(start_date))
+
+    return report_lib.drop_empty_months(report_lib.format_matrix(matrix))
+
+
+def derive_bottom_pages(response, start_date, bottom_pages):
+
+    # bottom_pages holds the (pagePath, pageTitle) pairs of the first pass
+    bottom_paths = list(dict.fromkeys(path for path, title in bottom_pages))
+    matrix = get_pivot_matrix(response, bottom_paths, ga4_lib.get_calendar_periods(start_date))
+
+    return report_lib.label_pages(report_lib.format_matrix(matrix), bottom_pages)
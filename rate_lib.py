@@ -0,0 +1,210 @@
+import os
+import time
+import json
+import fcntl
+import random
+import urllib.parse
+import retry_lib
+
+
+# Sheets allows 60 read and 60 write requests per minute per user
+READS_PER_MINUTE = 60
+WRITES_PER_MINUTE = 60
+
+# gspread methods that only read from the spreadsheet
+GSPREAD_READ_PREFIXES = ("get", "open", "worksheet", "fetch", "find", "batch_get", "row_values", "col_values", "acell", "cell")
+
+# spreadsheets.batchUpdate requests that leave the same sheet when applied twice
+REPEATABLE_SHEET_REQUESTS = ["repeatCell", "updateCells", "updateChartSpec", "updateConditionalFormatRule",
+    "updateDeveloperMetadata", "updateSheetProperties", "updateEmbeddedObjectPosition", "updateDimensionProperties"]
+
+
+
+class TokenBucket:
+    """
+    Token bucket kept in a JSON file under state_dir, so every script that
+    uses the same state_dir and name shares one budget. The file is locked
+    with flock while it is read and updated. A 429 from any of them pauses
+    all of them: penalize empties the bucket and blocks it for a delay that
+    doubles with each 429 seen within a minute of the previous one.
+    """
+
+    def __init__(self, state_dir, name, rate_per_minute, burst=10):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, "%s.bucket.json" % (name))
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1, min(burst, rate_per_minute))
+
+
+    def update(self, func):
+        # Run func on the current state under the file lock and store what it leaves
+        with open(self.path, "a+") as FW:
+            fcntl.flock(FW, fcntl.LOCK_EX)
+            FW.seek(0)
+            text = FW.read()
+            now = time.time()
+            state = json.loads(text) if text else {"tokens": self.capacity, "time": now, "blocked_until": 0, "strikes": 0}
+            state["tokens"] = min(self.capacity, state["tokens"] + (now - state["time"]) * self.rate)
+            state["time"] = now
+            result = func(state, now)
+            FW.seek(0)
+            FW.truncate()
+            json.dump(state, FW)
+        return result
+
+
+    def acquire(self):
+        while True:
+            wait = self.update(self.take_token)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+    def take_token(self, state, now):
+        if state["blocked_until"] > now:
+            return state["blocked_until"] - now
+        if state["tokens"] >= 1:
+            state["tokens"] -= 1
+            return 0
+        return (1 - state["tokens"]) / self.rate
+
+
+    def penalize(self):
+        return self.update(self.block)
+
+
+    def block(self, state, now):
+        if now - state["blocked_until"] > 60:
+            state["strikes"] = 0
+        delay = min(64, 2 ** state["strikes"]) + random.uniform(0, 1)
+        state["strikes"] += 1
+        state["tokens"] = 0
+        state["blocked_until"] = max(state["blocked_until"], now + delay)
+        return delay
+
+
+
+class RateLimiter:
+    """
+    Read and write buckets of one Sheets user. call retries a call that
+    got a 429 after the shared pause, up to max_retries times, since Sheets
+    did not apply it. A call that failed with any other retryable error may
+    have been applied, so it is retried after the retrier's backoff only if
+    it is repeatable, i.e. a read or a write that is safe to apply twice.
+    """
+
+    def __init__(self, state_dir, name, reads_per_minute=READS_PER_MINUTE, writes_per_minute=WRITES_PER_MINUTE, burst=10, max_retries=5, retrier=None):
+        self.buckets = {
+            "read": TokenBucket(state_dir, name + ".read", reads_per_minute, burst),
+            "write": TokenBucket(state_dir, name + ".write", writes_per_minute, burst)
+        }
+        self.max_retries = max_retries
+        self.retrier = retrier or retry_lib.Retrier()
+
+
+    def call(self, kind, repeatable, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.buckets[kind].acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not retry_lib.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                quota_exceeded = retry_lib.get_status(e) == 429
+                if not quota_exceeded and not repeatable:
+                    raise
+                if quota_exceeded:
+                    delay = self.buckets[kind].penalize()
+                    print(" ... Sheets quota exceeded, pausing %.1f seconds" % (delay))
+                else:
+                    delay = self.retrier.get_delay(attempt)
+                    print(" ... %s, retrying in %.1f seconds" % (retry_lib.get_error_name(e), delay))
+                    time.sleep(delay)
+                attempt += 1
+
+
+
+class RateLimitProxy:
+    """
+    Stands in for the Sheets service or the gspread client and sends every
+    call that reaches the API through a RateLimiter. With call_names set,
+    only those methods reach the API (execute() of a googleapiclient
+    request); otherwise every method does, as with gspread objects.
+    """
+
+    def __init__(self, target, limiter, call_names=None):
+        self._target = target
+        self._limiter = limiter
+        self._call_names = call_names
+
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        return RateLimitCall(self, name, value)
+
+
+
+class RateLimitCall:
+
+    def __init__(self, proxy, name, func):
+        self.proxy = proxy
+        self.name = name
+        self.func = func
+
+
+    def __call__(self, *args, **kwargs):
+        proxy = self.proxy
+        if proxy._call_names is not None and self.name not in proxy._call_names:
+            result = self.func(*args, **kwargs)
+        else:
+            kind = get_call_kind(proxy._target, self.name)
+            repeatable = kind == "read" or is_repeatable_write(proxy._target)
+            result = proxy._limiter.call(kind, repeatable, self.func, *args, **kwargs)
+
+        if result is None or isinstance(result, (dict, list, tuple, str, int, float, bool)):
+            return result
+        return RateLimitProxy(result, proxy._limiter, proxy._call_names)
+
+
+
+def get_call_kind(target, name):
+
+    # A googleapiclient request knows its HTTP method, gspread calls go by name
+    method = getattr(target, "method", None)
+    if isinstance(method, str):
+        return "read" if method.upper() == "GET" else "write"
+    return "read" if name.startswith(GSPREAD_READ_PREFIXES) else "write"
+
+
+def is_repeatable_write(target):
+
+    # Only googleapiclient requests show what they write, so gspread writes only retry a 429
+    uri = getattr(target, "uri", None)
+    if not isinstance(getattr(target, "method", None), str) or not isinstance(uri, str):
+        return False
+    path = urllib.parse.urlparse(uri).path
+    if path.endswith(":append") or path.endswith("/spreadsheets"):
+        return False
+    if not path.endswith(":batchUpdate") or path.endswith("/values:batchUpdate"):
+        return True
+    body = target.body or "{}"
+    request_list = json.loads(body.decode("utf-8") if isinstance(body, bytes) else body).get("requests", [])
+    return all(key in REPEATABLE_SHEET_REQUESTS for request in request_list for key in request)
+
+
+def get_limiter(domain, config_obj):
+
+    sheets_conf = config_obj.get("sheets", {})
+    return RateLimiter(
+        sheets_conf.get("state_dir", "cache"),
+        "sheets.%s" % (domain),
+        reads_per_minute=sheets_conf.get("reads_per_minute", READS_PER_MINUTE),
+        writes_per_minute=sheets_conf.get("writes_per_minute", WRITES_PER_MINUTE),
+        burst=sheets_conf.get("burst", 10),
+        max_retries=sheets_conf.get("max_retries", 5),
+        retrier=retry_lib.get_retrier(config_obj)
+    )
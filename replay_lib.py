@@ -0,0 +1,313 @@
+import os
+import json
+import base64
+import hashlib
+import inspect
+import datetime
+import tempfile
+import importlib
+import threading
+import proto
+
+
+# Environment variables naming the fixture directory to record to / replay from
+RECORD_ENV = "GA_REPGEN_RECORD"
+REPLAY_ENV = "GA_REPGEN_REPLAY"
+
+# File in the fixture directory holding the day it was recorded on
+RECORDING_FILE = "recording.json"
+
+
+
+class ReplayError(Exception):
+    pass
+
+
+
+class FixtureStore:
+    """
+    Fixture files of one API under fixture_dir/name, one JSON file per call.
+    A call is filed under a hash of its attribute path, and of its arguments
+    when match_args is set, plus a counter for repeated identical calls.
+    GA4 calls are matched on their requests; Sheets calls are matched on the
+    order they are made in, so a replay does not depend on the data written.
+    """
+
+    def __init__(self, fixture_dir, name, match_args=True):
+        self.path = os.path.join(fixture_dir, name)
+        os.makedirs(self.path, exist_ok=True)
+        self.match_args = match_args
+        self.counts = {}
+        self.lock = threading.Lock()
+
+
+    def get_file(self, call_path, consume=True):
+        if self.match_args:
+            key_obj = call_path
+        else:
+            key_obj = format_call(call_path)
+        key_str = json.dumps(key_obj, sort_keys=True, default=str)
+        key = hashlib.sha256(key_str.encode("utf-8")).hexdigest()[:24]
+
+        with self.lock:
+            count = self.counts.get(key, 0)
+            file_name = os.path.join(self.path, "%s-%d.json" % (key, count))
+            if consume:
+                self.counts[key] = count + 1
+
+        return file_name
+
+
+    def save(self, call_path, entry):
+        entry["call"] = call_path
+        with open(self.get_file(call_path), "w") as FW:
+            json.dump(entry, FW, indent=1, default=str)
+
+
+    def load(self, call_path):
+        file_name = self.get_file(call_path)
+        if not os.path.exists(file_name):
+            raise ReplayError("no recorded response for %s" % (format_call(call_path)))
+        with open(file_name) as FR:
+            return json.load(FR)
+
+
+    def has_attribute(self, call_path):
+        return os.path.exists(self.get_file(call_path, consume=False))
+
+
+
+class RecordProxy:
+    """
+    Stands in for an API object and records what every call through it
+    returns. Objects that cannot be stored, like a googleapiclient resource
+    or a gspread Worksheet, are wrapped in a RecordProxy of their own.
+    """
+
+    def __init__(self, target, store, call_path=None, async_target_factory=None):
+        self._target = target
+        self._store = store
+        self._call_path = call_path or []
+        self._async_target_factory = async_target_factory
+
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        call_path = self._call_path + [[name]]
+        if callable(value):
+            return RecordCall(value, self._store, call_path)
+        if is_plain(value):
+            self._store.save(call_path, {"result": encode_value(value)})
+            return value
+        self._store.save(call_path, {"proxy": True})
+        return RecordProxy(value, self._store, call_path)
+
+
+    def get_async_client(self):
+        return RecordProxy(self._async_target_factory(), self._store)
+
+
+
+class RecordCall:
+
+    def __init__(self, func, store, call_path):
+        self.func = func
+        self.store = store
+        self.call_path = call_path
+
+
+    def __call__(self, *args, **kwargs):
+        call_path = self.call_path[:-1] + [self.call_path[-1] + [encode_value(list(args)), encode_value(kwargs)]]
+        try:
+            result = self.func(*args, **kwargs)
+        except Exception as e:
+            self.store.save(call_path, {"error": get_error_entry(e)})
+            raise
+        if inspect.isawaitable(result):
+            return self.record_async(result, call_path)
+        return self.record(result, call_path)
+
+
+    async def record_async(self, awaitable, call_path):
+        try:
+            result = await awaitable
+        except Exception as e:
+            self.store.save(call_path, {"error": get_error_entry(e)})
+            raise
+        return self.record(result, call_path)
+
+
+    def record(self, result, call_path):
+        if is_plain(result):
+            self.store.save(call_path, {"result": encode_value(result)})
+            return result
+        self.store.save(call_path, {"proxy": True})
+        return RecordProxy(result, self.store, call_path)
+
+
+
+class ReplayProxy:
+    """
+    Stands in for an API object during replay, answering every call from the
+    fixtures a RecordProxy wrote. With is_async set, calls return coroutines
+    like those of BetaAnalyticsDataAsyncClient.
+    """
+
+    def __init__(self, store, call_path=None, is_async=False):
+        self._store = store
+        self._call_path = call_path or []
+        self._is_async = is_async
+
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        call_path = self._call_path + [[name]]
+        # Plain attributes were recorded, methods were not
+        if self._store.has_attribute(call_path):
+            return get_replay_result(self._store, call_path, self._is_async)
+        return ReplayCall(self._store, call_path, self._is_async)
+
+
+    def get_async_client(self):
+        return ReplayProxy(self._store, is_async=True)
+
+
+
+class ReplayCall:
+
+    def __init__(self, store, call_path, is_async):
+        self.store = store
+        self.call_path = call_path
+        self.is_async = is_async
+
+
+    def __call__(self, *args, **kwargs):
+        call_path = self.call_path[:-1] + [self.call_path[-1] + [encode_value(list(args)), encode_value(kwargs)]]
+        if self.is_async:
+            return self.replay_async(call_path)
+        return get_replay_result(self.store, call_path, self.is_async)
+
+
+    async def replay_async(self, call_path):
+        return get_replay_result(self.store, call_path, self.is_async)
+
+
+
+def get_replay_result(store, call_path, is_async):
+
+    entry = store.load(call_path)
+    if "error" in entry:
+        raise get_error(entry["error"])
+    if entry.get("proxy"):
+        return ReplayProxy(store, call_path, is_async)
+
+    return decode_value(entry["result"])
+
+
+def is_plain(value):
+
+    if value is None or isinstance(value, (str, int, float, bool, proto.Message)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(is_plain(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and is_plain(item) for key, item in value.items())
+
+    return False
+
+
+def encode_value(value):
+
+    if isinstance(value, proto.Message):
+        return {
+            "__proto__": "%s.%s" % (type(value).__module__, type(value).__qualname__),
+            "json": json.loads(type(value).to_json(value)),
+            "data": base64.b64encode(type(value).serialize(value)).decode("ascii")
+        }
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): encode_value(item) for key, item in value.items()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+
+    # numpy scalars and the like
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def decode_value(value):
+
+    if isinstance(value, dict) and "__proto__" in value:
+        module_name, class_name = value["__proto__"].rsplit(".", 1)
+        message_type = getattr(importlib.import_module(module_name), class_name)
+        return message_type.deserialize(base64.b64decode(value["data"]))
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: decode_value(item) for key, item in value.items()}
+
+    return value
+
+
+def get_error_entry(e):
+
+    return {"type": "%s.%s" % (type(e).__module__, type(e).__qualname__), "message": str(e)}
+
+
+def get_error(error_entry):
+
+    module_name, class_name = error_entry["type"].rsplit(".", 1)
+    try:
+        return getattr(importlib.import_module(module_name), class_name)(error_entry["message"])
+    except Exception:
+        return ReplayError("%s: %s" % (error_entry["type"], error_entry["message"]))
+
+
+def format_call(call_path):
+
+    return ".".join(segment[0] + ("()" if len(segment) > 1 else "") for segment in call_path)
+
+
+def isolate_config(config_obj):
+
+    # Requests must not depend on what earlier runs stored: no report cache,
+    # no month store and a checkpoint that starts out empty
+    ga4_conf = config_obj.setdefault("ga4", {})
+    ga4_conf["cache_dir"] = None
+    ga4_conf["incremental"] = False
+    config_obj.setdefault("retry", {})["checkpoint_dir"] = tempfile.mkdtemp(prefix="ga-repgen-")
+
+    return config_obj
+
+
+def get_recorded_date():
+
+    # The day the fixtures of a replayed run were recorded on, None outside replay
+    fixture_dir = os.environ.get(REPLAY_ENV)
+    if not fixture_dir or not os.path.exists(os.path.join(fixture_dir, RECORDING_FILE)):
+        return None
+    with open(os.path.join(fixture_dir, RECORDING_FILE)) as FR:
+        return datetime.date.fromisoformat(json.load(FR)["date"])
+
+
+def get_record_clients(fixture_dir, client, service, gc, async_client_factory):
+
+    os.makedirs(fixture_dir, exist_ok=True)
+    with open(os.path.join(fixture_dir, RECORDING_FILE), "w") as FW:
+        json.dump({"date": datetime.date.today().isoformat()}, FW)
+
+    return (
+        RecordProxy(client, FixtureStore(fixture_dir, "ga4"), async_target_factory=async_client_factory),
+        RecordProxy(service, FixtureStore(fixture_dir, "sheets", match_args=False)),
+        RecordProxy(gc, FixtureStore(fixture_dir, "gspread", match_args=False))
+    )
+
+
+def get_replay_clients(fixture_dir):
+
+    return (
+        ReplayProxy(FixtureStore(fixture_dir, "ga4")),
+        ReplayProxy(FixtureStore(fixture_dir, "sheets", match_args=False)),
+        ReplayProxy(FixtureStore(fixture_dir, "gspread", match_args=False))
+    )
@@ -0,0 +1,69 @@
+import pandas as pd
+import ga4_lib
+
+
+
+def get_month_sums(df, key_dim, metric_name, key_list=None):
+
+    # metric_name summed by month and key_dim, only over key_list when given
+    if key_list is not None:
+        df = df[df[key_dim].isin(key_list)]
+    if "Month-Year" not in df:
+        df = df.assign(**{"Month-Year": ga4_lib.get_month_keys(df)})
+
+    return df.groupby(["Month-Year", key_dim], sort=False, observed=True)[metric_name].sum()
+
+
+def concat_sums(sums_list, dtype=int):
+
+    # Sums of the pages of one report, none when it was never requested
+    if not sums_list:
+        return pd.Series([], dtype=dtype, index=pd.MultiIndex.from_arrays([[], []]))
+    return pd.concat(sums_list)
+
+
+def get_month_matrix(sums, key_list=None, month_list=None, dtype=int):
+
+    # Sums of several pages of the same report are added up first
+    if not sums.index.is_unique:
+        sums = sums.groupby(level=[0, 1], sort=False).sum()
+    matrix = sums.unstack()
+
+    # key_list orders the columns, month_list fills in months without rows
+    if key_list is not None:
+        matrix = matrix.reindex(columns=key_list)
+    if month_list is not None:
+        matrix = matrix.reindex(index=month_list)
+    matrix = matrix.fillna(0).astype(dtype)
+    matrix.index.name = 'Month-Year'
+    matrix.columns.name = None
+
+    return matrix
+
+
+def get_month_table(df, key_dim, metric_name, key_list=None, month_list=None, dtype=int):
+
+    # Month x key matrix of one decoded report or cube; without keys GA4 was not asked, only months are left
+    if key_list is not None and len(key_list) == 0:
+        return get_month_matrix(concat_sums([], dtype), key_list, month_list, dtype)
+    return get_month_matrix(get_month_sums(df, key_dim, metric_name, key_list), key_list, month_list, dtype)
+
+
+def format_matrix(matrix):
+
+    # Period keys as the first column, latest month first
+    return ga4_lib.sort_by_month(matrix.reset_index())
+
+
+def drop_empty_months(df):
+
+    # Filter out rows where all numeric columns are 0
+    numeric_columns = df.columns.drop('Month-Year')
+    return df[~(df[numeric_columns] == 0).all(axis=1)]
+
+
+def label_pages(df, pages):
+
+    # Format column headers of (pagePath, pageTitle) pairs with page titles
+    header_mapping = {path: f"{title}\n({path})" for path, title in pages}
+    return df.rename(columns=header_mapping)
@@ -0,0 +1,213 @@
+import os
+import time
+import random
+import sqlite3
+import inspect
+import asyncio
+import datetime
+
+
+# How often a failed call is retried and the bounds of the wait before each retry
+MAX_RETRIES = 5
+BASE_DELAY = 1
+MAX_DELAY = 64
+
+# HTTP status codes, and gRPC status codes of the GA4 client, worth another try
+RETRYABLE_HTTP_CODES = [408, 429, 500, 502, 503, 504]
+RETRYABLE_GRPC_CODES = ["UNAVAILABLE", "DEADLINE_EXCEEDED", "RESOURCE_EXHAUSTED", "ABORTED", "INTERNAL", "UNKNOWN"]
+
+
+
+class Retrier:
+    """
+    Calls a function again when it fails with an error is_retryable accepts,
+    at most max_retries times. Before retry n it waits between half and all
+    of min(max_delay, base_delay * 2**n) seconds, so runs that failed together
+    do not retry together.
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.get_delay(attempt)
+                print(" ... %s, retrying in %.1f seconds" % (get_error_name(e), delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+    async def call_async(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.get_delay(attempt)
+                print(" ... %s, retrying in %.1f seconds" % (get_error_name(e), delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+
+class RetryProxy:
+    """
+    Stands in for the GA4 client and sends every method call through a
+    Retrier; coroutine methods, like those of BetaAnalyticsDataAsyncClient,
+    are retried with call_async. get_async_client wraps the client made by
+    async_target_factory the same way.
+    """
+
+    def __init__(self, target, retrier, async_target_factory=None):
+        self._target = target
+        self._retrier = retrier
+        self._async_target_factory = async_target_factory
+
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        return RetryCall(self._retrier, value)
+
+
+    def get_async_client(self):
+        return RetryProxy(self._async_target_factory(), self._retrier)
+
+
+
+class RetryCall:
+
+    def __init__(self, retrier, func):
+        self.retrier = retrier
+        self.func = func
+
+
+    def __call__(self, *args, **kwargs):
+        if inspect.iscoroutinefunction(self.func):
+            return self.retrier.call_async(self.func, *args, **kwargs)
+        return self.retrier.call(self.func, *args, **kwargs)
+
+
+
+class Checkpoint:
+    """
+    What a run has finished so far, in a SQLite file under state_dir named
+    after the script run: the GA4 responses it fetched and a digest of every
+    tab it wrote. A run that fails leaves the file behind and a rerun on the
+    same day resumes from it, so reports already fetched are not requested
+    again and tabs already written are not read or written again. clear()
+    removes the file once a run has finished.
+    """
+
+    def __init__(self, state_dir, name):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, "%s.checkpoint.sqlite" % (name))
+        self.day = datetime.date.today().isoformat()
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stages (key TEXT PRIMARY KEY, day TEXT, data BLOB)")
+        # What a run of an earlier day left behind is out of date
+        self.conn.execute("DELETE FROM stages WHERE day != ?", (self.day,))
+        self.conn.commit()
+
+
+    def get_data(self, key):
+        row = self.conn.execute("SELECT data FROM stages WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def set_data(self, key, data):
+        self.conn.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?)", (key, self.day, data))
+        self.conn.commit()
+
+
+    def get(self, key, response_type):
+        # Same interface as ga4_lib.ReportCache
+        data = self.get_data("report:" + key)
+        return response_type.deserialize(data) if data is not None else None
+
+
+    def put(self, key, response):
+        self.set_data("report:" + key, type(response).serialize(response))
+
+
+    def get_period(self, key):
+        # First month GA4 was asked for in a monthly report (see ga4_lib.MonthStore)
+        data = self.get_data("period:" + key)
+        return int(data) if data is not None else None
+
+
+    def put_period(self, key, period):
+        self.set_data("period:" + key, str(period))
+
+
+    def is_done(self, stage, digest=""):
+        return self.get_data("stage:" + stage) == digest
+
+
+    def mark_done(self, stage, digest=""):
+        self.set_data("stage:" + stage, digest)
+
+
+    def clear(self):
+        self.conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+
+def get_status(e):
+
+    # googleapiclient's HttpError carries resp.status, google.api_core and gspread errors carry code
+    resp = getattr(e, "resp", None)
+    if resp is not None and hasattr(resp, "status"):
+        return int(resp.status)
+    code = getattr(e, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(e):
+
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    grpc_code = getattr(e, "grpc_status_code", None)
+    if grpc_code is not None and getattr(grpc_code, "name", None) in RETRYABLE_GRPC_CODES:
+        return True
+    return get_status(e) in RETRYABLE_HTTP_CODES
+
+
+def get_error_name(e):
+
+    status = get_status(e)
+    return "%s (%s)" % (type(e).__name__, status) if status is not None else type(e).__name__
+
+
+def get_retrier(config_obj):
+
+    retry_conf = config_obj.get("retry", {})
+    return Retrier(
+        max_retries=retry_conf.get("max_retries", MAX_RETRIES),
+        base_delay=retry_conf.get("base_delay", BASE_DELAY),
+        max_delay=retry_conf.get("max_delay", MAX_DELAY)
+    )
+
+
+def get_checkpoint(config_obj, name):
+
+    return Checkpoint(config_obj.get("retry", {}).get("checkpoint_dir", "cache"), name)
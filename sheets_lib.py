@@ -0,0 +1,555 @@
+import copy
+import json
+import hashlib
+import itertools
+import numpy as np
+import pandas as pd
+
+
+# Red at the minimum, white at the median and green at the maximum of a column
+GRADIENT_RULE = {
+    'minpoint': {'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404}, 'type': 'MIN'},
+    'midpoint': {'color': {'red': 1, 'green': 1, 'blue': 1}, 'type': 'PERCENTILE', 'value': '50'},
+    'maxpoint': {'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420}, 'type': 'MAX'}
+}
+
+# Background per outlier class: more than 1 and 0.5 to 1 standard deviations
+# below (-2, -1) or above (1, 2) the column mean, and close to it (0)
+OUTLIER_COLORS = {
+    -2: {'red': 0.839, 'green': 0.404, 'blue': 0.404},
+    -1: {'red': 0.957, 'green': 0.800, 'blue': 0.800},
+    0: {'red': 1, 'green': 1, 'blue': 1},
+    1: {'red': 0.851, 'green': 0.918, 'blue': 0.827},
+    2: {'red': 0.420, 'green': 0.655, 'blue': 0.420}
+}
+
+# Developer metadata key of a tab holding the digest of its outlier colors
+OUTLIER_METADATA_KEY = "outlierColors"
+
+# Column of monthly tables holding integer period keys (year * 12 + month - 1)
+MONTH_COLUMN = "Month-Year"
+
+# Everything a run needs to know about the tabs, without cell data
+METADATA_FIELDS = (
+    "sheets(properties(sheetId,title,gridProperties),conditionalFormats,charts(chartId,spec,position),"
+    "developerMetadata(metadataId,metadataKey,metadataValue))"
+)
+
+# batchUpdate requests that change what METADATA_FIELDS covers
+STRUCTURAL_REQUESTS = [
+    "addSheet", "deleteSheet", "updateSheetProperties",
+    "appendDimension", "insertDimension", "deleteDimension",
+    "addConditionalFormatRule", "updateConditionalFormatRule", "deleteConditionalFormatRule",
+    "addChart", "updateChartSpec", "updateEmbeddedObjectPosition", "deleteEmbeddedObject",
+    "createDeveloperMetadata", "updateDeveloperMetadata"
+]
+
+
+
+class TableHandle:
+    """
+    Where a table written through SheetsBatch.write_table lives and what
+    shape it has, header row included, so later stages like charts need
+    not read the tab back.
+    """
+
+    def __init__(self, sheet_title, sheet_id, columns, num_rows):
+        self.sheet_title = sheet_title
+        self.sheet_id = sheet_id
+        self.columns = columns
+        self.num_rows = num_rows
+        self.num_columns = len(columns)
+
+
+
+class SheetsBatch:
+    """
+    Collects everything a run writes to one spreadsheet: tab values,
+    conditional format rules, charts and any other batchUpdate requests.
+    flush reads the values of all buffered tabs with one values.batchGet,
+    diffs them, and sends all changes as one values.batchUpdate and one
+    spreadsheets.batchUpdate; rows a table lost are blanked in the same call.
+    The spreadsheets.batchUpdate goes first and grows every tab whose grid
+    is too small for its table or the anchor cells of its charts, so the
+    values always fit.
+    Spreadsheet metadata is fetched once with METADATA_FIELDS and shared by
+    every tab of the run; it is dropped whenever a batchUpdate changes the
+    spreadsheet's structure, and tabs added through add_sheet are patched in.
+    Cell colors set through sync_cell_colors are only sent when they differ
+    from what the tab's developer metadata says it last got.
+    With a retry_lib.Checkpoint, tabs an earlier failed run of the same day
+    already wrote with the same values are neither read nor written again.
+    """
+
+    def __init__(self, service, spreadsheet_id, checkpoint=None):
+        self.service = service
+        self.spreadsheet_id = spreadsheet_id
+        self.checkpoint = checkpoint
+        self.tables = {}
+        self.requests = []
+        self.format_rules = {}
+        self.charts = {}
+        self.cell_colors = {}
+        self.metadata = None
+
+
+    def get_metadata(self):
+        if self.metadata is None:
+            self.metadata = self.service.spreadsheets().get(
+                spreadsheetId=self.spreadsheet_id,
+                fields=METADATA_FIELDS
+            ).execute()
+        return self.metadata
+
+
+    def get_sheet(self, sheet_title):
+        for sheet in self.get_metadata().get("sheets", []):
+            if sheet["properties"]["title"] == sheet_title:
+                return sheet
+        return None
+
+
+    def get_sheet_id(self, sheet_title, create=False):
+        sheet = self.get_sheet(sheet_title)
+        if sheet is not None:
+            return sheet["properties"].get("sheetId", 0)
+        if create:
+            return self.add_sheet(sheet_title)
+        raise ValueError("Sheet '%s' not found" % (sheet_title))
+
+
+    def add_sheet(self, sheet_title, rows=100, cols=20):
+        # New tabs are created right away, since the other requests need their sheetId
+        response = self.service.spreadsheets().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={'requests': [{
+                'addSheet': {
+                    'properties': {'title': sheet_title, 'gridProperties': {'rowCount': rows, 'columnCount': cols}}
+                }
+            }]}
+        ).execute()
+        properties = response["replies"][0]["addSheet"]["properties"]
+        self.get_metadata().setdefault("sheets", []).append({"properties": properties})
+        return properties.get("sheetId", 0)
+
+
+    def write_table(self, sheet_title, df):
+        self.tables[sheet_title] = get_table_values(format_month_column(df))
+        return TableHandle(sheet_title, self.get_sheet_id(sheet_title), df.columns.tolist(), len(df) + 1)
+
+
+    def add_requests(self, requests):
+        self.requests += requests
+
+
+    def sync_format_rules(self, sheet_id, rules, requests=None):
+        # The tab's conditional format rules become exactly rules
+        self.requests += requests or []
+        self.format_rules[sheet_id] = rules
+
+
+    def sync_cell_colors(self, sheet_id, classes, start_row=1, start_col=1):
+        # Backgrounds from the OUTLIER_COLORS class matrix; the gradient rules
+        # the tab got before would paint over them and are dropped in flush
+        self.cell_colors[sheet_id] = (classes, start_row, start_col)
+
+
+    def sync_charts(self, sheet_id, charts):
+        # Charts are matched to the tab's existing charts by title
+        self.charts[sheet_id] = self.charts.get(sheet_id, []) + charts
+
+
+    def flush(self):
+        data = []
+        digest_dict = {sheet_title: get_values_digest(values) for sheet_title, values in self.tables.items()}
+        title_list = [
+            sheet_title for sheet_title in self.tables
+            if self.checkpoint is None or not self.checkpoint.is_done("tab:" + sheet_title, digest_dict[sheet_title])
+        ]
+        if title_list:
+            response = self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=[get_sheet_range(sheet_title) for sheet_title in title_list],
+                valueRenderOption="UNFORMATTED_VALUE"
+            ).execute()
+            # valueRanges come back in the order of ranges
+            for sheet_title, value_range in zip(title_list, response.get("valueRanges", [])):
+                data += get_changed_ranges(sheet_title, value_range.get("values", []), self.tables[sheet_title])
+
+        requests = list(self.requests)
+        if self.tables or self.format_rules or self.charts or self.cell_colors:
+            sheet_dict = {sheet["properties"].get("sheetId", 0): sheet for sheet in self.get_metadata().get("sheets", [])}
+            requests = self.get_grid_requests(sheet_dict) + requests
+            for sheet_id, rules in self.format_rules.items():
+                current_rules = sheet_dict.get(sheet_id, {}).get("conditionalFormats", [])
+                requests += get_format_rule_requests(sheet_id, current_rules, rules)
+            for sheet_id, charts in self.charts.items():
+                current_charts = sheet_dict.get(sheet_id, {}).get("charts", [])
+                requests += get_chart_requests(current_charts, charts)
+            for sheet_id, (classes, start_row, start_col) in self.cell_colors.items():
+                current_rules = sheet_dict.get(sheet_id, {}).get("conditionalFormats", [])
+                requests += get_gradient_rule_delete_requests(sheet_id, current_rules)
+                requests += get_cell_color_requests(sheet_dict.get(sheet_id, {}), sheet_id, classes, start_row, start_col)
+
+        if requests:
+            self.service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': requests}
+            ).execute()
+            if any(name in STRUCTURAL_REQUESTS for request in requests for name in request):
+                self.metadata = None
+        if data:
+            self.service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={"valueInputOption": "RAW", "data": data}
+            ).execute()
+        if self.checkpoint is not None:
+            for sheet_title in title_list:
+                self.checkpoint.mark_done("tab:" + sheet_title, digest_dict[sheet_title])
+
+        self.tables, self.requests, self.format_rules, self.charts, self.cell_colors = {}, [], {}, {}, {}
+        return data, requests
+
+
+    def get_grid_requests(self, sheet_dict):
+        # Rows and columns each tab needs for its table and chart anchors
+        size_dict = {}
+        for sheet_title, values in self.tables.items():
+            sheet_id = self.get_sheet_id(sheet_title)
+            size_dict[sheet_id] = get_table_size(values)
+        for sheet_id, charts in self.charts.items():
+            for chart in charts:
+                anchor_cell = chart["position"].get("overlayPosition", {}).get("anchorCell")
+                if anchor_cell is not None:
+                    num_rows, num_columns = size_dict.get(sheet_id, (0, 0))
+                    size_dict[sheet_id] = (
+                        max(num_rows, anchor_cell.get("rowIndex", 0) + 1),
+                        max(num_columns, anchor_cell.get("columnIndex", 0) + 1)
+                    )
+
+        requests = []
+        for sheet_id, (num_rows, num_columns) in size_dict.items():
+            grid_properties = sheet_dict.get(sheet_id, {}).get("properties", {}).get("gridProperties")
+            if grid_properties is not None:
+                requests += get_grid_size_requests(sheet_id, grid_properties, num_rows, num_columns)
+        return requests
+
+
+
+def get_month_labels(periods):
+
+    # "MM, YYYY" for each period key, formatted once per distinct month
+    label_dict = {period: "%02d, %d" % (period % 12 + 1, period // 12) for period in periods.unique()}
+    return periods.map(label_dict)
+
+
+def format_month_column(df):
+
+    # Period keys are only turned into labels here, where the table leaves for Sheets
+    if MONTH_COLUMN in df.columns and pd.api.types.is_integer_dtype(df[MONTH_COLUMN]):
+        df = df.assign(**{MONTH_COLUMN: get_month_labels(df[MONTH_COLUMN])})
+    return df
+
+
+def get_table_values(df):
+
+    return [df.columns.tolist()] + df.values.tolist()
+
+
+def get_values_digest(values):
+
+    return hashlib.sha256(json.dumps(values, default=str).encode("utf-8")).hexdigest()
+
+
+def get_table_size(values):
+
+    return len(values), max((len(row) for row in values), default=0)
+
+
+def get_grid_size_requests(sheet_id, grid_properties, num_rows, num_columns):
+
+    # Grids only grow, so nothing placed beyond the table is cut off
+    requests = []
+    for dimension, count, needed in (
+        ("ROWS", grid_properties.get("rowCount", 0), num_rows),
+        ("COLUMNS", grid_properties.get("columnCount", 0), num_columns)
+    ):
+        if needed > count:
+            requests.append({'appendDimension': {'sheetId': sheet_id, 'dimension': dimension, 'length': needed - count}})
+    return requests
+
+
+def get_sheet_range(sheet_title, cell_range=None):
+
+    # A1 notation with the tab title quoted, so titles with spaces or quotes work
+    sheet_range = "'%s'" % (sheet_title.replace("'", "''"))
+    if cell_range is not None:
+        sheet_range += "!" + cell_range
+    return sheet_range
+
+
+def get_column_letter(col_idx):
+
+    # 0 -> A, 25 -> Z, 26 -> AA
+    letters = ""
+    col_idx += 1
+    while col_idx > 0:
+        col_idx, rem = divmod(col_idx - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def normalize_cell(value):
+
+    # Sheets returns 5 for a cell written as 5.0 and drops trailing empty cells
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    return str(value)
+
+
+def get_changed_ranges(sheet_title, current_values, new_values):
+
+    # Runs of changed cells per row, blanking cells the new table no longer covers
+    n_rows = max(len(current_values), len(new_values))
+    row_runs = []
+    for row_idx in range(n_rows):
+        current_row = current_values[row_idx] if row_idx < len(current_values) else []
+        new_row = new_values[row_idx] if row_idx < len(new_values) else []
+        run = None
+        for col_idx in range(max(len(current_row), len(new_row))):
+            current_cell = current_row[col_idx] if col_idx < len(current_row) else ""
+            new_cell = new_row[col_idx] if col_idx < len(new_row) else ""
+            if normalize_cell(current_cell) == normalize_cell(new_cell):
+                run = None
+                continue
+            if run is None:
+                run = [row_idx, col_idx, []]
+                row_runs.append(run)
+            run[2].append(new_cell)
+
+    # Runs over the same columns of consecutive rows become one rectangle
+    blocks = []
+    for row_idx, col_idx, cells in row_runs:
+        last = blocks[-1] if blocks else None
+        if last is not None and last[0] + len(last[2]) == row_idx and last[1] == col_idx and len(last[2][0]) == len(cells):
+            last[2].append(cells)
+        else:
+            blocks.append([row_idx, col_idx, [cells]])
+
+    data = []
+    for row_idx, col_idx, rows in blocks:
+        cell_range = "%s%d:%s%d" % (
+            get_column_letter(col_idx), row_idx + 1,
+            get_column_letter(col_idx + len(rows[0]) - 1), row_idx + len(rows)
+        )
+        data.append({"range": get_sheet_range(sheet_title, cell_range), "values": rows})
+
+    return data
+
+
+def get_gradient_rule(sheet_id, col_idx, start_row=1, end_row=None):
+
+    grid_range = {
+        'sheetId': sheet_id,
+        'startRowIndex': start_row,
+        'startColumnIndex': col_idx,
+        'endColumnIndex': col_idx + 1
+    }
+    if end_row is not None:
+        grid_range['endRowIndex'] = end_row
+    return {'ranges': [grid_range], 'gradientRule': copy.deepcopy(GRADIENT_RULE)}
+
+
+def is_gradient_rule(rule):
+
+    # Rules of the form get_gradient_rule makes, which the outlier tabs used to carry
+    ranges = rule.get("ranges", [])
+    return (
+        normalize_object(rule.get("gradientRule")) == normalize_object(GRADIENT_RULE)
+        and len(ranges) == 1 and ranges[0].get("endColumnIndex", 0) - ranges[0].get("startColumnIndex", 0) == 1
+    )
+
+
+def get_gradient_rule_delete_requests(sheet_id, current_rules):
+
+    # Only those rules go, from the last one down so the remaining indexes stay valid
+    return [
+        {'deleteConditionalFormatRule': {'sheetId': sheet_id, 'index': index}}
+        for index in range(len(current_rules) - 1, -1, -1) if is_gradient_rule(current_rules[index])
+    ]
+
+
+def get_outlier_classes(df):
+
+    # z-scores of all columns at once; constant columns and single rows stay 0
+    values = df.to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (values - df.mean().to_numpy(dtype=float)) / df.std().to_numpy(dtype=float)
+    return np.select([z > 1, z > 0.5, z < -1, z < -0.5], [2, 1, -2, -1], 0).astype(np.int8)
+
+
+def get_class_ranges(classes):
+
+    # (row, end_row, col, end_col, class) rectangles of one outlier class other than 0:
+    # runs of equal classes along each row, extended down while the next row has the same run
+    open_dict, range_list = {}, []
+    for row_idx, row in enumerate(classes.tolist() + [[]]):
+        run_dict, col_idx = {}, 0
+        for class_id, group in itertools.groupby(row):
+            end_col = col_idx + len(list(group))
+            if class_id != 0:
+                run_dict[(col_idx, end_col, class_id)] = open_dict.pop((col_idx, end_col, class_id), row_idx)
+            col_idx = end_col
+        range_list += [(start_row, row_idx, col, end_col, class_id) for (col, end_col, class_id), start_row in open_dict.items()]
+        open_dict = run_dict
+
+    return sorted(range_list)
+
+
+def get_cell_color_requests(sheet, sheet_id, classes, start_row=1, start_col=1):
+
+    # Nothing to send while the tab's developer metadata holds the digest of these colors
+    digest = hashlib.sha256(
+        json.dumps([classes.shape, start_row, start_col]).encode("utf-8") + classes.astype(np.int8).tobytes()
+    ).hexdigest()
+    current_metadata = None
+    for metadata in sheet.get("developerMetadata", []):
+        if metadata.get("metadataKey") == OUTLIER_METADATA_KEY:
+            current_metadata = metadata
+    if current_metadata is not None and current_metadata.get("metadataValue") == digest:
+        return []
+
+    # The previous grid extent is cleared first, so colors left over from a larger
+    # table go; then one repeatCell per rectangle of cells of the same outlier class
+    n_rows, n_cols = classes.shape
+    grid_properties = sheet.get("properties", {}).get("gridProperties", {})
+    requests = [{
+        'repeatCell': {
+            'range': {
+                'sheetId': sheet_id,
+                'startRowIndex': start_row,
+                'endRowIndex': max(grid_properties.get("rowCount", 0), start_row + n_rows),
+                'startColumnIndex': start_col,
+                'endColumnIndex': max(grid_properties.get("columnCount", 0), start_col + n_cols)
+            },
+            'cell': {},
+            'fields': 'userEnteredFormat.backgroundColor'
+        }
+    }]
+    for row_idx, end_row, col_idx, end_col, class_id in get_class_ranges(classes):
+        requests.append({
+            'repeatCell': {
+                'range': {
+                    'sheetId': sheet_id,
+                    'startRowIndex': start_row + row_idx,
+                    'endRowIndex': start_row + end_row,
+                    'startColumnIndex': start_col + col_idx,
+                    'endColumnIndex': start_col + end_col
+                },
+                'cell': {'userEnteredFormat': {'backgroundColor': OUTLIER_COLORS[class_id]}},
+                'fields': 'userEnteredFormat.backgroundColor'
+            }
+        })
+
+    if current_metadata is None:
+        requests.append({
+            'createDeveloperMetadata': {
+                'developerMetadata': {
+                    'metadataKey': OUTLIER_METADATA_KEY,
+                    'metadataValue': digest,
+                    'location': {'sheetId': sheet_id},
+                    'visibility': 'DOCUMENT'
+                }
+            }
+        })
+    else:
+        requests.append({
+            'updateDeveloperMetadata': {
+                'dataFilters': [{'developerMetadataLookup': {'metadataId': current_metadata["metadataId"]}}],
+                'developerMetadata': {'metadataValue': digest},
+                'fields': 'metadataValue'
+            }
+        })
+
+    return requests
+
+
+def normalize_object(value):
+
+    # Sheets leaves out zero fields, adds colorStyle next to color and stores colors as floats;
+    # numbers taken from a DataFrame are numpy scalars
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, dict):
+        normalized = {key: normalize_object(item) for key, item in value.items() if not key.endswith("Style")}
+        return {key: item for key, item in normalized.items() if item not in (0, None, "", [], {})}
+    if isinstance(value, list):
+        return [normalize_object(item) for item in value]
+    if isinstance(value, float):
+        return round(value, 3)
+    return value
+
+
+def contains_object(current, value):
+
+    # Sheets fills in defaults the request left out, so only the fields value sets are compared
+    if isinstance(value, dict):
+        current = current if isinstance(current, dict) else {}
+        return all(contains_object(current.get(key), item) for key, item in value.items() if not key.endswith("Style"))
+    if isinstance(value, list):
+        current = current if isinstance(current, list) else []
+        return len(current) == len(value) and all(contains_object(*pair) for pair in zip(current, value))
+
+    return normalize_object({"value": current}) == normalize_object({"value": value})
+
+
+def get_format_rule_requests(sheet_id, current_rules, rules):
+
+    # Rules are compared by position, so an unchanged tab needs no requests
+    requests = []
+    for index, rule in enumerate(rules):
+        if index >= len(current_rules):
+            requests.append({'addConditionalFormatRule': {'rule': rule, 'index': index}})
+        elif normalize_object(current_rules[index]) != normalize_object(rule):
+            requests.append({'updateConditionalFormatRule': {'sheetId': sheet_id, 'index': index, 'rule': rule}})
+
+    # Surplus rules go from the last one down so the remaining indexes stay valid
+    for index in range(len(current_rules) - 1, len(rules) - 1, -1):
+        requests.append({'deleteConditionalFormatRule': {'sheetId': sheet_id, 'index': index}})
+
+    return requests
+
+
+def get_chart_requests(current_charts, charts):
+
+    # A chart is owned by its title: one with the same title is updated in place,
+    # copies piled up by earlier runs are deleted and missing charts are added
+    chart_dict = {}
+    for chart in current_charts:
+        chart_dict.setdefault(chart.get("spec", {}).get("title"), []).append(chart)
+
+    requests = []
+    for chart in charts:
+        current_list = chart_dict.get(chart["spec"]["title"], [])
+        if not current_list:
+            requests.append({'addChart': {'chart': chart}})
+            continue
+        current_chart = current_list[0]
+        if not contains_object(current_chart.get("spec"), chart["spec"]):
+            requests.append({'updateChartSpec': {'chartId': current_chart["chartId"], 'spec': chart["spec"]}})
+        if normalize_object(current_chart.get("position")) != normalize_object(chart["position"]):
+            requests.append({
+                'updateEmbeddedObjectPosition': {
+                    'objectId': current_chart["chartId"],
+                    'newPosition': chart["position"],
+                    'fields': '*'
+                }
+            })
+        for duplicate_chart in current_list[1:]:
+            requests.append({'deleteEmbeddedObject': {'objectId': duplicate_chart["chartId"]}})
+
+    return requests
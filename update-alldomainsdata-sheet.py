@@ -1,19 +1,22 @@
-import os, sys
+import sys
 import json
-import numpy as np
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, OrderBy, MetricType
+from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, RunReportResponse, RunPivotReportResponse, OrderBy, MetricType
 import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gspread
 import json_lib
+import ga4_lib
+import client_lib
+import cube_lib
+import channel_lib
+import pivot_lib
+import report_lib
+import sheets_lib
+import retry_lib
 from optparse import OptionParser
 
 
 
 
-def create_combined_ga4_report():
+def get_combined_ga4_requests():
     # Main GA4 metrics request
     main_request = RunReportRequest(
         property='properties/' + config_obj["property_id"],
@@ -33,9 +36,8 @@ def create_combined_ga4_report():
         property='properties/' + config_obj["property_id"],
         dimensions=[
             Dimension(name="year"),
-            Dimension(name="month"),
-            Dimension(name="sessionSource")
-        ],
+            Dimension(name="month")
+        ] + [Dimension(name=field) for field in classifier.fields],
         metrics=[Metric(name="sessions")],
         order_bys=[
             OrderBy(dimension={'dimension_name': 'year'}, desc=True),
@@ -44,91 +46,43 @@ def create_combined_ga4_report():
         date_ranges=[DateRange(start_date="2020-01-01", end_date="today")]
     )
 
-    # Send requests
-    main_response = client.run_report(main_request)
-    traffic_source_response = client.run_report(traffic_source_request)
+    return main_request, traffic_source_request
+
+
+def create_combined_ga4_report(main_response, traffic_source_response):
 
     # Process main metrics (updated)
     def process_main_metrics(response):
-        data_dict = {}
-        
-        for row in response.rows:
-            year = int(row.dimension_values[0].value)
-            month = int(row.dimension_values[1].value)
-            user_type = row.dimension_values[2].value
-            
-            key = (year, month)
-            if key not in data_dict:
-                data_dict[key] = {
-                    'total_users': 0,
-                    'active_users': 0,
-                    'new_users': 0,
-                    'returning_users': 0,
-                    'event_count': 0,
-                    'sessions': 0
-                }
-            
-            # Handle user types
-            if user_type == "new":
-                data_dict[key]['new_users'] += float(row.metric_values[0].value)
-            elif user_type == "returning":
-                data_dict[key]['returning_users'] += float(row.metric_values[0].value)
-            
-            # Aggregate metrics
-            data_dict[key]['active_users'] += float(row.metric_values[1].value)
-            data_dict[key]['event_count'] += float(row.metric_values[2].value)
-            data_dict[key]['sessions'] += float(row.metric_values[3].value)
-            
-            # Calculate total users
-            data_dict[key]['total_users'] = (
-                data_dict[key]['new_users'] + 
-                data_dict[key]['returning_users']
-            )
-
-        # Convert to DataFrame
-        data = []
-        for (year, month), metrics in data_dict.items():
-            data.append([
-                year,
-                month,
-                metrics['total_users'],
-                metrics['active_users'],
-                metrics['new_users'],
-                metrics['returning_users'],
-                metrics['event_count'],
-                metrics['sessions']
-            ])
-    
-        return pd.DataFrame(data, columns=[
-            "Year", "Month", "Total Users", "Users/Active Users", 
+        df = ga4_lib.decode_response(response)
+
+        # Handle user types
+        df['new_users'] = df['totalUsers'].where(df['newVsReturning'] == "new", 0)
+        df['returning_users'] = df['totalUsers'].where(df['newVsReturning'] == "returning", 0)
+
+        # Aggregate metrics
+        metric_list = ['new_users', 'returning_users', 'activeUsers', 'eventCount', 'sessions']
+        df = df.groupby(['year', 'month'], sort=False)[metric_list].sum().astype(float).reset_index()
+
+        # Calculate total users
+        df['total_users'] = df['new_users'] + df['returning_users']
+        df['Month-Year'] = ga4_lib.get_month_keys(df)
+
+        df = df.rename(columns={
+            'total_users': "Total Users", 'activeUsers': "Users/Active Users",
+            'new_users': "New Users", 'returning_users': "Returning Users", 'eventCount': "Hits/Events",
+            'sessions': "Sessions"
+        })
+        return df[[
+            "Month-Year", "Total Users", "Users/Active Users", 
             "New Users", "Returning Users", "Hits/Events", "Sessions"
-        ])
+        ]]
 
     # Process traffic sources
     def process_traffic_sources(response):
-        data = {}
-        for row in response.rows:
-            year = int(row.dimension_values[0].value)
-            month = int(row.dimension_values[1].value)
-            source = row.dimension_values[2].value
-            sessions = float(row.metric_values[0].value)
-            
-            key = f"{month:02}, {year}"
-            if key not in data:
-                data[key] = {"Organic Search": 0, "Direct": 0, "Referral": 0}
-            
-            if source.lower() == "google":
-                data[key]["Organic Search"] += sessions
-            elif source.lower() == "(direct)":
-                data[key]["Direct"] += sessions
-            elif source.lower() not in ["google", "(direct)"]:
-                data[key]["Referral"] += sessions
-
-        df = pd.DataFrame.from_dict(data, orient='index', columns=["Organic Search", "Direct", "Referral"])
-        df.index.name = "Month-Year"
-        df = df.reset_index()
-        
-        return df
+        df = ga4_lib.decode_response(response)
+        df['channel'] = classifier.classify(df)
+
+        return report_lib.get_month_table(df, 'channel', 'sessions', classifier.channels, dtype=float).reset_index()
 
     # Process both datasets
     main_df = process_main_metrics(main_response)
@@ -136,126 +90,31 @@ def create_combined_ga4_report():
 
     # Combine datasets (updated)
     def combine_datasets(main_df, traffic_sources_df):
-        # Create Month-Year column for both dataframes
-        main_df['Month-Year'] = main_df['Month'].apply(lambda x: f'{x:02}') + ', ' + main_df['Year'].astype(str)
-        
-        # Merge dataframes
+        # Merge dataframes on their period keys
         combined_df = pd.merge(main_df, traffic_sources_df, on='Month-Year', how='left')
         
         # Reorder and select columns
         columns_order = [
             'Month-Year', 'Total Users', 'Users/Active Users', 
-            'New Users', 'Returning Users', 'Hits/Events', 'Sessions',
-            'Organic Search', 'Direct', 'Referral'
-        ]
+            'New Users', 'Returning Users', 'Hits/Events', 'Sessions'
+        ] + classifier.channels
         combined_df = combined_df[columns_order]
         
-        # Create datetime column for sorting
-        combined_df['Sort_Date'] = pd.to_datetime(combined_df['Month-Year'], format='%m, %Y')
-        
         # Sort in descending order
-        combined_df = combined_df.sort_values('Sort_Date', ascending=False)
-        
-        # Drop sorting column
-        combined_df = combined_df.drop(columns=['Sort_Date'])
-        
-        return combined_df
+        return ga4_lib.sort_by_month(combined_df)
 
     return combine_datasets(main_df, traffic_sources_df)
 
 
-def add_color_formatting(df):
-    """
-    Add color formatting based on trends and outliers
-    Color coding:
-    - Green: Above average (positive trend)
-    - Red: Below average (negative trend)
-    - Yellow: Slightly different from average
-    """
-    def get_color_class(column):
-        # Calculate mean and standard deviation
-        mean = df[column].mean()
-        std = df[column].std()
-        
-        def color_mapper(value):
-            # More than 1 std dev above mean
-            if value > mean + std:
-                return 'positive-high-outlier'
-            # Between 0.5 and 1 std dev above mean
-            elif value > mean + (std/2):
-                return 'positive-mild-outlier'
-            # More than 1 std dev below mean
-            elif value < mean - std:
-                return 'negative-high-outlier'
-            # Between 0.5 and 1 std dev below mean
-            elif value < mean - (std/2):
-                return 'negative-mild-outlier'
-            # Close to average
-            else:
-                return 'average'
-        
-        return df[column].apply(color_mapper)
-    
-    # Columns to analyze (excluding Month-Year)
-    numeric_columns = df.columns.drop('Month-Year').tolist()
-    
-    # Create color mapping for each column
-    color_mapping = {col: get_color_class(col) for col in numeric_columns}
-    
-    return df, color_mapping
-
 # Google Sheets API setup and export
-def export_to_google_sheets(df, color_mapping):
-    # Convert DataFrame to list of lists for Google Sheets
-    values = [df.columns.tolist()] + df.values.tolist()
-
-    # Update the sheet
-    request = service.spreadsheets().values().update(
-        spreadsheetId=config_obj["sheet_id"],
-        range=SHEET_TITLE + '!A1',
-        valueInputOption='RAW',
-        body={'values': values}
-    )
-    response = request.execute()
-
-    # Formatting colors
-    gc = gspread.authorize(creds)
-    sheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-
-    batch_update_requests = [{
-            'addConditionalFormatRule': {
-                'rule': {
-                    'ranges': [{
-                        'sheetId': sheet.id,
-                        'startRowIndex': 1,  # Skip header row
-                        'startColumnIndex': col_idx - 1,
-                        'endColumnIndex': col_idx
-                    }],
-                    'gradientRule': {
-                        'minpoint': {
-                            'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404},  # Red
-                            'type': 'MIN'
-                        },
-                        'midpoint': {
-                            'color': {'red': 1, 'green': 1, 'blue': 1},  # White
-                            'type': 'PERCENTILE',
-                            'value': '50'
-                        },
-                        'maxpoint': {
-                            'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420},  # Green
-                            'type': 'MAX'
-                        }
-                    }
-                }
-            }
-        } for col_idx, col_name in enumerate(df.columns[1:], start=2)]  # Skip first column
-
-    # Execute batch update
-    if batch_update_requests:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body={'requests': batch_update_requests}
-        ).execute()
+def export_to_google_sheets(df):
+    # Write only the cells that changed
+    batch.write_table(SHEET_TITLE, df)
+
+    sheet_id = batch.get_sheet_id(SHEET_TITLE)
+
+    # Color each cell by how far it lies from its column's mean, first column skipped
+    batch.sync_cell_colors(sheet_id, sheets_lib.get_outlier_classes(df[df.columns[1:]]))
     #print(f"{response.get('updatedCells')} cells updated.")
 
     return
@@ -265,14 +124,7 @@ def export_to_google_sheets(df, color_mapping):
 
 def update_charts(df):
     
-    spreadsheet = service.spreadsheets().get(spreadsheetId=config_obj["sheet_id"]).execute()
-    sheet_id = None
-    for sheet in spreadsheet['sheets']:
-        if sheet['properties']['title'] == SHEET_TITLE:
-            sheet_id = sheet['properties']['sheetId']
-            break
-    if sheet_id is None:
-        raise ValueError("Sheet '%s' not found" % (SHEET_TITLE))
+    sheet_id = batch.get_sheet_id(SHEET_TITLE)
 
     # Calculate the y-axis range
     max_value = df[['Total Users', 'Users/Active Users', 'Returning Users', 'New Users']].max().max()
@@ -280,53 +132,14 @@ def update_charts(df):
     y_axis_max = max_value * 1.1
     y_axis_min = max(0, min_value * 0.9)
 
-    # First, delete any existing charts
-    delete_charts_request = {
-        'requests': [{
-            'deleteEmbeddedObject': {
-                'objectId': chart['chartId']
-            }
-        } for chart in spreadsheet.get('sheets', [])[0].get('charts', [])]
-    }
-
-    if delete_charts_request['requests']:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body=delete_charts_request
-        ).execute()
-
-    # Define the new chart
+    # Define the charts
     start_row_index, end_row_index = 0, df.shape[0] + 1 
     metric_chart_obj = json_lib.get_user_metrics_chart_json(sheet_id, y_axis_min, y_axis_max, start_row_index, end_row_index)
-    chart_request = {
-        'requests': [{
-            'addChart': {
-                'chart': metric_chart_obj
-            }
-        }]
-    }
-    response = service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body=chart_request
-    ).execute()
-    #print("User metrics chart updated successfully in %s sheet." % (SHEET_TITLE))
-
-
-    start_row_index, end_row_index = 0, df.shape[0] + 1
     traffic_chart_obj = json_lib.get_traffic_chart_json(sheet_id, start_row_index, end_row_index)
-    traffic_chart_request = {
-        'requests': [{
-            'addChart': {
-                'chart': traffic_chart_obj
-            }
-        }]
-    }
 
-    response = service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body=traffic_chart_request
-    ).execute()
-    #print("Traffic chart updated successfully in %s sheet." % (SHEET_TITLE))
+    # Update the tab's charts in place, adding them on the first run
+    batch.sync_charts(sheet_id, [metric_chart_obj, traffic_chart_obj])
+    #print("Charts updated successfully in %s sheet." % (SHEET_TITLE))
 
 
 
@@ -337,7 +150,7 @@ def update_charts(df):
 
 
 
-def create_bottom_pages_trend_report():
+def get_bottom_pages_request():
 
     # First request: Get overall bottom 10 pages
     bottom_pages_request = RunReportRequest(
@@ -356,11 +169,17 @@ def create_bottom_pages_trend_report():
         date_ranges=[DateRange(start_date="2023-12-01", end_date="today")]
     )
 
-    bottom_pages_response = client.run_report(bottom_pages_request)
-    bottom_pages = [(row.dimension_values[0].value, row.dimension_values[1].value) 
-                   for row in bottom_pages_response.rows]
+    return bottom_pages_request
+
 
-    # Second request: Get monthly data with explicit date range
+def get_bottom_pages_monthly_request(bottom_pages_response):
+
+    # Without pages there is nothing to ask GA4 for
+    path_list = ga4_lib.get_dimension_values(bottom_pages_response, "pagePath")
+    if not path_list:
+        return None
+
+    # Second request: Get monthly data for the bottom pages only
     monthly_request = RunReportRequest(
         property='properties/' + config_obj["property_id"],
         dimensions=[
@@ -376,101 +195,36 @@ def create_bottom_pages_trend_report():
             OrderBy(dimension={"dimension_name": "month"}, desc=True)
         ],
         date_ranges=[DateRange(start_date="2023-12-01", end_date="today")],
+        dimension_filter=ga4_lib.get_in_list_filter("pagePath", path_list),
         limit=50000
     )
 
-    monthly_response = client.run_report(monthly_request)
+    return monthly_request
 
-    # Process monthly data with explicit date range handling
-    monthly_data = {}
-    
-    # Create all month-year combinations from 2020 to today
-    current_date = pd.Timestamp.now()
-    start_date = pd.Timestamp('2023-12-01')
-    date_range = pd.date_range(start=start_date, end=current_date, freq='M')
-    
-    # Initialize the dictionary with all possible months
-    for date in date_range:
-        month_key = f"{date.month:02d}, {date.year}"
-        monthly_data[month_key] = {page[0]: 0 for page in bottom_pages}
-
-    # Fill in the actual data
-    for row in monthly_response.rows:
-        year = int(row.dimension_values[0].value)
-        month = int(row.dimension_values[1].value)
-        page_path = row.dimension_values[2].value
-        views = int(row.metric_values[0].value)
-        
-        month_key = f"{month:02d}, {year}"
-        if month_key in monthly_data and page_path in monthly_data[month_key]:
-            monthly_data[month_key][page_path] = views
-
-    # Create DataFrame with all months
-    df = pd.DataFrame.from_dict(monthly_data, orient='index')
-    df.index.name = 'Month-Year'
-    df = df.reset_index()
-
-    # Sort by date (latest first)
-    df['Sort_Date'] = pd.to_datetime(df['Month-Year'], format='%m, %Y')
-    df = df.sort_values('Sort_Date', ascending=False)
-    df = df.drop('Sort_Date', axis=1)
-
-    # Format column headers with page titles
-    header_mapping = {page[0]: f"{page[1]}\n({page[0]})" for page in bottom_pages}
-    df = df.rename(columns=header_mapping)
-
-
-    # Convert DataFrame to values
-    values = [df.columns.tolist()] + df.values.tolist()
-
-    # Update the sheet
-    request = service.spreadsheets().values().update(
-        spreadsheetId=config_obj["sheet_id"],
-        range=f'{SHEET_TITLE}!A1',
-        valueInputOption='RAW',
-        body={'values': values}
-    )
-    response = request.execute()
 
-    # Format header
-    gc = gspread.authorize(creds)
-    sheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-    
-    format_requests = [{
-        'repeatCell': {
-            'range': {
-                'sheetId': sheet.id,
-                'startRowIndex': 0,
-                'endRowIndex': 1
-            },
-            'cell': {
-                'userEnteredFormat': {
-                    'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9},
-                    'textFormat': {'bold': True},
-                    'wrapStrategy': 'WRAP',
-                    'verticalAlignment': 'MIDDLE',
-                    'horizontalAlignment': 'CENTER'
-                }
-            },
-            'fields': 'userEnteredFormat(backgroundColor,textFormat,wrapStrategy,verticalAlignment,horizontalAlignment)'
-        }
-    }]
+def create_bottom_pages_trend_report(bottom_pages_response, monthly_response):
 
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body={'requests': format_requests}
-    ).execute()
+    bottom_df = ga4_lib.decode_response(bottom_pages_response)
+    bottom_pages = list(zip(bottom_df['pagePath'].astype(str), bottom_df['pageTitle'].astype(str)))
+    bottom_paths = list(dict.fromkeys(page[0] for page in bottom_pages))
 
+    # Create all month-year combinations from 2020 to today
+    month_list = ga4_lib.get_calendar_periods('2023-12-01')
 
-    return
+    # Lay the monthly views out as months x pages, with every possible month
+    df = ga4_lib.decode_response(monthly_response)
+    matrix = report_lib.get_month_table(df, 'pagePath', 'screenPageViews', bottom_paths, month_list)
 
+    # Latest month first, with page titles in the column headers
+    return report_lib.label_pages(report_lib.format_matrix(matrix), bottom_pages)
 
 
 
 
 
 
-def create_top_referrals_trend_report():
+
+def get_top_referrals_request():
 
     # First request: Get overall top 10 referral sources
     top_referrals_request = RunReportRequest(
@@ -498,11 +252,17 @@ def create_top_referrals_trend_report():
         }
     )
 
-    top_referrals_response = client.run_report(top_referrals_request)
-    top_referrals = [(row.dimension_values[0].value, row.dimension_values[1].value) 
-                     for row in top_referrals_response.rows]
+    return top_referrals_request
+
 
-    # Second request: Get monthly data for these referral sources
+def get_referrals_monthly_request(top_referrals_response):
+
+    # Without referral sources there is nothing to ask GA4 for
+    source_list = ga4_lib.get_dimension_values(top_referrals_response, "sessionSource")
+    if not source_list:
+        return None
+
+    # Second request: Get monthly data for these referral sources only
     monthly_request = RunReportRequest(
         property='properties/' + config_obj["property_id"],
         dimensions=[
@@ -518,70 +278,40 @@ def create_top_referrals_trend_report():
             OrderBy(dimension={"dimension_name": "month"}, desc=True)
         ],
         date_ranges=[DateRange(start_date="2020-01-01", end_date="today")],
+        dimension_filter=ga4_lib.get_in_list_filter("sessionSource", source_list),
         limit=50000
     )
 
-    monthly_response = client.run_report(monthly_request)
+    return monthly_request
+
+
+def create_top_referrals_trend_report(top_referrals_response, monthly_response):
+
+    top_referrals = ga4_lib.get_dimension_values(top_referrals_response, 'sessionSource')
 
-    # Process monthly data
-    monthly_data = {}
-    
     # Create all month-year combinations
-    current_date = pd.Timestamp.now()
-    start_date = pd.Timestamp('2020-01-01')
-    date_range = pd.date_range(start=start_date, end=current_date, freq='M')
-    
-    # Initialize the dictionary with all possible months
-    for date in date_range:
-        month_key = f"{date.month:02d}, {date.year}"
-        monthly_data[month_key] = {referral[0]: 0 for referral in top_referrals}
-
-    # Fill in the actual data
-    for row in monthly_response.rows:
-        year = int(row.dimension_values[0].value)
-        month = int(row.dimension_values[1].value)
-        source = row.dimension_values[2].value
-        sessions = int(row.metric_values[0].value)
-        
-        month_key = f"{month:02d}, {year}"
-        if month_key in monthly_data and source in monthly_data[month_key]:
-            monthly_data[month_key][source] = sessions
-
-    # Create DataFrame
-    df = pd.DataFrame.from_dict(monthly_data, orient='index')
-    df.index.name = 'Month-Year'
-    df = df.reset_index()
-
-    # Sort by date (latest first)
-    df['Sort_Date'] = pd.to_datetime(df['Month-Year'], format='%m, %Y')
-    df = df.sort_values('Sort_Date', ascending=False)
-    df = df.drop('Sort_Date', axis=1)
-
-    # Filter out rows where all numeric columns are 0
-    numeric_columns = df.columns.drop('Month-Year')
-    df = df[~(df[numeric_columns] == 0).all(axis=1)]
-
-
-    # Convert DataFrame to values
-    values = [df.columns.tolist()] + df.values.tolist()
-
-    # Update the sheet
-    request = service.spreadsheets().values().update(
-        spreadsheetId=config_obj["sheet_id"],
-        range=f'{SHEET_TITLE}!A1',
-        valueInputOption='RAW',
-        body={'values': values}
-    )
-    response = request.execute()
+    month_list = ga4_lib.get_calendar_periods('2020-01-01')
+
+    # Lay the monthly sessions out as months x sources, with every possible month
+    df = ga4_lib.decode_response(monthly_response)
+    matrix = report_lib.get_month_table(df, 'sessionSource', 'sessions', top_referrals, month_list)
+
+    # Latest month first, without months that had no sessions from these sources
+    return report_lib.drop_empty_months(report_lib.format_matrix(matrix))
+
+
+def export_trend_report(df):
+
+    # Write only the cells that changed
+    batch.write_table(SHEET_TITLE, df)
 
     # Format header
-    gc = gspread.authorize(creds)
-    sheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
+    sheet_id = batch.get_sheet_id(SHEET_TITLE)
     
     format_requests = [{
         'repeatCell': {
             'range': {
-                'sheetId': sheet.id,
+                'sheetId': sheet_id,
                 'startRowIndex': 0,
                 'endRowIndex': 1
             },
@@ -598,14 +328,9 @@ def create_top_referrals_trend_report():
         }
     }]
 
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body={'requests': format_requests}
-    ).execute()
-
+    batch.add_requests(format_requests)
 
-
-    return df
+    return
 
 
 
@@ -613,15 +338,7 @@ def create_top_referrals_trend_report():
 def add_top_referrals_chart(df):
     
     # Get sheet ID
-    spreadsheet = service.spreadsheets().get(spreadsheetId=config_obj["sheet_id"]).execute()
-    sheet_id = None
-    for sheet in spreadsheet['sheets']:
-        if sheet['properties']['title'] == SHEET_TITLE:
-            sheet_id = sheet['properties']['sheetId']
-            break
-            
-    if sheet_id is None:
-        raise ValueError(f"Sheet '{SHEET_TITLE}' not found")
+    sheet_id = batch.get_sheet_id(SHEET_TITLE)
 
     # Get the number of columns
     num_columns = len(df.columns)
@@ -705,19 +422,8 @@ def add_top_referrals_chart(df):
         }
         chart['spec']['basicChart']['series'].append(series)
 
-    # Add the chart
-    chart_request = {
-        'requests': [{
-            'addChart': {
-                'chart': chart
-            }
-        }]
-    }
-
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body=chart_request
-    ).execute()
+    # Update the chart in place, adding it on the first run
+    batch.sync_charts(sheet_id, [chart])
 
 
 
@@ -744,31 +450,94 @@ def main():
 
     global config_obj
     global client
-    global creds
     global service
+    global batch
+    global classifier
     global SHEET_TITLE
     
 
     config_obj = json.load(open("conf/config.%s.json" % (domain)))
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
-    credentials_file = "conf/credentials.%s.json" % (domain)
-    # Initialize the GA4 client
-    client = BetaAnalyticsDataClient()
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
-    service = build('sheets', 'v4', credentials=creds)
+    client, service, gc = client_lib.get_clients(domain, config_obj)
+    classifier = channel_lib.get_classifier(config_obj)
+    # A rerun after a failure picks up where this run stopped
+    checkpoint = retry_lib.get_checkpoint(config_obj, "alldomainsdata.%s" % (domain))
+    batch = sheets_lib.SheetsBatch(service, config_obj["sheet_id"], checkpoint)
     SHEET_TITLE = "Updated_AllDomains_Data"
 
 
 
+    collector = ga4_lib.get_collector(client, config_obj, checkpoint)
+    if config_obj.get("ga4", {}).get("engine") == "cube":
+        # Derive all three tabs from the shared fact cube
+        cube = cube_lib.build_cube(collector, config_obj, report_list=["users", "sources", "pages"])
+        df = cube_lib.derive_alldomains_data(cube, classifier=classifier)
+        referrals_df = cube_lib.derive_top_referrals(cube, "2020-01-01")
+        bottom_pages_df = cube_lib.derive_bottom_pages(cube, "2023-12-01")
+    elif config_obj.get("ga4", {}).get("engine") == "pivot":
+        main_request, traffic_source_request = get_combined_ga4_requests()
+        collector.add("main", main_request)
+        collector.add("traffic_source", traffic_source_request)
+        collector.add("top_referrals", get_top_referrals_request())
+        collector.add("bottom_pages", get_bottom_pages_request())
+        responses = collector.run()
+
+        # GA4 returns the month x key matrices of the first round's keys directly, if there are any
+        source_list = ga4_lib.get_dimension_values(responses["top_referrals"], "sessionSource")
+        if source_list:
+            collector.add("referrals_monthly", pivot_lib.get_monthly_pivot_request(
+                config_obj["property_id"], "sessionSource", "sessions", "2020-01-01", key_limit=len(source_list),
+                dimension_filter=ga4_lib.get_in_list_filter("sessionSource", source_list)
+            ))
+        bottom_df = ga4_lib.decode_response(responses["bottom_pages"])
+        bottom_pages = list(zip(bottom_df["pagePath"].astype(str), bottom_df["pageTitle"].astype(str)))
+        path_list = ga4_lib.get_dimension_values(responses["bottom_pages"], "pagePath")
+        if path_list:
+            collector.add("bottom_pages_monthly", pivot_lib.get_monthly_pivot_request(
+                config_obj["property_id"], "pagePath", "screenPageViews", "2023-12-01", key_limit=len(path_list),
+                desc=False, dimension_filter=ga4_lib.get_in_list_filter("pagePath", path_list)
+            ))
+        responses.update(collector.run())
+
+        df = create_combined_ga4_report(responses["main"], responses["traffic_source"])
+        referrals_df = pivot_lib.derive_top_referrals(
+            responses.get("referrals_monthly", RunPivotReportResponse()), "2020-01-01", source_list
+        )
+        bottom_pages_df = pivot_lib.derive_bottom_pages(
+            responses.get("bottom_pages_monthly", RunPivotReportResponse()), "2023-12-01", bottom_pages
+        )
+    else:
+        # Send all GA4 requests of this run through batch_run_reports
+        main_request, traffic_source_request = get_combined_ga4_requests()
+        collector.add("main", main_request)
+        collector.add("traffic_source", traffic_source_request)
+        collector.add("top_referrals", get_top_referrals_request())
+        collector.add("bottom_pages", get_bottom_pages_request())
+        responses = collector.run()
+
+        # The monthly reports only ask for the keys of the first round, if there are any
+        monthly_dict = {
+            "referrals_monthly": get_referrals_monthly_request(responses["top_referrals"]),
+            "bottom_pages_monthly": get_bottom_pages_monthly_request(responses["bottom_pages"])
+        }
+        for key, monthly_request in monthly_dict.items():
+            if monthly_request is not None:
+                collector.add(key, monthly_request)
+        responses.update(collector.run())
+
+        df = create_combined_ga4_report(responses["main"], responses["traffic_source"])
+        referrals_df = create_top_referrals_trend_report(
+            responses["top_referrals"], responses.get("referrals_monthly", RunReportResponse())
+        )
+        bottom_pages_df = create_bottom_pages_trend_report(
+            responses["bottom_pages"], responses.get("bottom_pages_monthly", RunReportResponse())
+        )
+
     # Main execution
-    df = create_combined_ga4_report()
 
-    df_with_colors, color_mapping = add_color_formatting(df)
-    export_to_google_sheets(df_with_colors, color_mapping)
+    export_to_google_sheets(df)
 
     # Optional: Print the first few rows and color mapping
-    #print(df_with_colors.head())
+    #print(df.head())
     #print("\nColor Mapping Legend:")
     #print("- Green shades: Performance above average (light to dark intensity)")
     #print("- Red shades: Performance below average (light to dark intensity)")
@@ -778,18 +547,20 @@ def main():
     print("\n ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
     SHEET_TITLE = 'AllDomains_Top10Referrals'
-    df = create_top_referrals_trend_report()
+    export_trend_report(referrals_df)
     print(" ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
-    add_top_referrals_chart(df)
+    add_top_referrals_chart(referrals_df)
     print(" ... FINISHED UPDATING CHART IN sheet=%s" % (SHEET_TITLE))
 
 
     SHEET_TITLE = 'AllDomains_Bottom10Pages'  # Changed sheet title
-    create_bottom_pages_trend_report()
+    export_trend_report(bottom_pages_df)
     print(" ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
-
+    # Send everything written above as one values and one spreadsheets batchUpdate
+    batch.flush()
+    checkpoint.clear()
 
     return
 
@@ -1,20 +1,23 @@
-import os, sys
+import sys
 import json
 import numpy as np
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, OrderBy, MetricType
+from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, RunReportResponse, OrderBy, MetricType
 import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gspread
 import json_lib
+import ga4_lib
+import client_lib
+import cube_lib
+import pivot_lib
+import report_lib
+import sheets_lib
+import retry_lib
 from optparse import OptionParser
 
 
 
 
 
-def create_top_countries_report():
+def get_top_countries_request():
 
     # Get top 10 countries data
     request = RunReportRequest(
@@ -32,59 +35,31 @@ def create_top_countries_report():
         date_ranges=[DateRange(start_date="2023-04-01", end_date="today")]
     )
 
-    response = client.run_report(request)
+    return request
+
+
+def create_top_countries_report(response):
 
     # Process data into DataFrame
-    data = []
-    for row in response.rows:
-        country = row.dimension_values[0].value
-        pageviews = int(row.metric_values[0].value)
-        data.append([country, pageviews])
+    df = ga4_lib.decode_response(response)
+    df = pd.DataFrame({"Country": df["country"].astype(str), "Pageviews": df["screenPageViews"]})
+
+    return df
 
-    df = pd.DataFrame(data, columns=["Country", "Pageviews"])
 
-    gc = gspread.authorize(creds)
+def export_top_countries_report(df):
+
     
     
     # Create new sheet if it doesn't exist
-    try:
-        worksheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-        worksheet.clear()
-    except:
-        worksheet = gc.open_by_key(config_obj["sheet_id"]).add_worksheet(SHEET_TITLE, rows=100, cols=20)
-
-    # Convert DataFrame to values
-    values = [df.columns.tolist()] + df.values.tolist()
-    
-    # Update sheet
-    worksheet.update(values, "A1")
+    sheet_id = batch.get_sheet_id(SHEET_TITLE, create=True)
+
+    # Write only the cells that changed
+    batch.write_table(SHEET_TITLE, df)
 
     # Apply conditional formatting to pageviews column
-    format_request = {
-        'requests': [{
-            'addConditionalFormatRule': {
-                'rule': {
-                    'ranges': [{
-                        'sheetId': worksheet.id,
-                        'startRowIndex': 1,
-                        'endRowIndex': len(values),
-                        'startColumnIndex': 1,
-                        'endColumnIndex': 2
-                    }],
-                    'gradientRule': {
-                        'minpoint': {'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404}, 'type': 'MIN'},
-                        'midpoint': {'color': {'red': 1, 'green': 1, 'blue': 1}, 'type': 'PERCENTILE', 'value': '50'},
-                        'maxpoint': {'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420}, 'type': 'MAX'}
-                    }
-                }
-            }
-        }]
-    }
-    
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body=format_request
-    ).execute()
+    rules = [sheets_lib.get_gradient_rule(sheet_id, 1, end_row=len(df) + 1)]
+    batch.sync_format_rules(sheet_id, rules)
 
     return
 
@@ -93,248 +68,186 @@ def create_top_countries_report():
 
 
 
-def create_top_countries_report_monthly():
-    try:
-        # First get top 10 countries overall
-        top_countries_request = RunReportRequest(
-            property='properties/' + config_obj["property_id"],
-            dimensions=[
-                Dimension(name="country")
-            ],
-            metrics=[
-                Metric(name="engagedSessions")
-            ],
-            order_bys=[
-                OrderBy(metric={"metric_name": "engagedSessions"}, desc=True)
-            ],
-            limit=10,
-            date_ranges=[DateRange(start_date="2023-04-01", end_date="today")]
-        )
+def get_top_countries_monthly_keys_request():
 
-        top_countries_response = client.run_report(top_countries_request)
-        top_countries = [row.dimension_values[0].value for row in top_countries_response.rows]
-
-        # Then get monthly data for these countries
-        monthly_request = RunReportRequest(
-            property='properties/' + config_obj["property_id"],
-            dimensions=[
-                Dimension(name="year"),
-                Dimension(name="month"),
-                Dimension(name="country")
-            ],
-            metrics=[
-                Metric(name="engagedSessions")
-            ],
-            order_bys=[
-                OrderBy(dimension={"dimension_name": "year"}, desc=True),
-                OrderBy(dimension={"dimension_name": "month"}, desc=True)
-            ],
-            date_ranges=[DateRange(start_date="2023-04-01", end_date="today")]
-        )
+    # First get top 10 countries overall
+    top_countries_request = RunReportRequest(
+        property='properties/' + config_obj["property_id"],
+        dimensions=[
+            Dimension(name="country")
+        ],
+        metrics=[
+            Metric(name="engagedSessions")
+        ],
+        order_bys=[
+            OrderBy(metric={"metric_name": "engagedSessions"}, desc=True)
+        ],
+        limit=10,
+        date_ranges=[DateRange(start_date="2023-04-01", end_date="today")]
+    )
 
-        monthly_response = client.run_report(monthly_request)
-
-        # Process into a dictionary with flattened structure
-        monthly_data = {}
-        total_monthly_sessions = {}
-        
-        for row in monthly_response.rows:
-            year = int(row.dimension_values[0].value)
-            month = int(row.dimension_values[1].value)
-            country = row.dimension_values[2].value
-            
-            if country in top_countries:
-                month_key = f"{month:02d}, {year}"
-                if month_key not in monthly_data:
-                    monthly_data[month_key] = {country: 0 for country in top_countries}
-                    total_monthly_sessions[month_key] = 0
-                
-                sessions = int(row.metric_values[0].value)
-                monthly_data[month_key][country] = sessions
-                total_monthly_sessions[month_key] += sessions
-
-        # Create DataFrame
-        df = pd.DataFrame.from_dict(monthly_data, orient='index')
-        df['Total Engaged Sessions'] = pd.Series(total_monthly_sessions)
-        df.index.name = 'Month-Year'
-        df = df.reset_index()
-
-        # Sort by date
-        df['Sort_Date'] = pd.to_datetime(df['Month-Year'], format='%m, %Y')
-        df = df.sort_values('Sort_Date', ascending=False)
-        df = df.drop('Sort_Date', axis=1)
-
-        # Reorder columns to put Total first
-        cols = ['Month-Year', 'Total Engaged Sessions'] + [col for col in df.columns if col not in ['Month-Year', 'Total Engaged Sessions']]
-        df = df[cols]
-
-        # Export to Google Sheets
-        gc = gspread.authorize(creds)
-
-        # Create or get worksheet
-        try:
-            worksheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-        except:
-            worksheet = gc.open_by_key(config_obj["sheet_id"]).add_worksheet(SHEET_TITLE, rows=100, cols=20)
-
-        # Clear existing content
-        worksheet.clear()
-
-        # Update values
-        values = [df.columns.tolist()] + df.values.tolist()
-        worksheet.update(values, "A1",value_input_option='RAW')
-
-        # Apply formatting
-        format_requests = []
-        
-        # Add header formatting
-        format_requests.append({
-            'repeatCell': {
-                'range': {
-                    'sheetId': worksheet.id,
-                    'startRowIndex': 0,
-                    'endRowIndex': 1
-                },
-                'cell': {
-                    'userEnteredFormat': {
-                        'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9},
-                        'textFormat': {'bold': True},
-                        'horizontalAlignment': 'CENTER'
+    return top_countries_request
+
+
+def get_top_countries_monthly_request(top_countries_response):
+
+    # Without countries there is nothing to ask GA4 for
+    country_list = ga4_lib.get_dimension_values(top_countries_response, "country")
+    if not country_list:
+        return None
+
+    # Then get monthly data for these countries only
+    monthly_request = RunReportRequest(
+        property='properties/' + config_obj["property_id"],
+        dimensions=[
+            Dimension(name="year"),
+            Dimension(name="month"),
+            Dimension(name="country")
+        ],
+        metrics=[
+            Metric(name="engagedSessions")
+        ],
+        order_bys=[
+            OrderBy(dimension={"dimension_name": "year"}, desc=True),
+            OrderBy(dimension={"dimension_name": "month"}, desc=True)
+        ],
+        date_ranges=[DateRange(start_date="2023-04-01", end_date="today")],
+        dimension_filter=ga4_lib.get_in_list_filter("country", country_list)
+    )
+
+    return monthly_request
+
+
+def create_top_countries_report_monthly(top_countries_response, monthly_response):
+    top_countries = ga4_lib.get_dimension_values(top_countries_response, 'country')
+
+    # Lay the monthly sessions of the top countries out as months x countries
+    df = ga4_lib.decode_response(monthly_response)
+    matrix = report_lib.get_month_table(df, 'country', 'engagedSessions', top_countries)
+
+    # Total first, latest month first
+    matrix.insert(0, 'Total Engaged Sessions', matrix.sum(axis=1))
+    return report_lib.format_matrix(matrix)
+
+
+def export_top_countries_report_monthly(df):
+    # Export to Google Sheets
+
+    # Create or get worksheet
+    sheet_id = batch.get_sheet_id(SHEET_TITLE, create=True)
+
+    # Write only the cells that changed
+    batch.write_table(SHEET_TITLE, df)
+
+    # Apply formatting
+    format_requests = []
+    
+    # Add header formatting
+    format_requests.append({
+        'repeatCell': {
+            'range': {
+                'sheetId': sheet_id,
+                'startRowIndex': 0,
+                'endRowIndex': 1
+            },
+            'cell': {
+                'userEnteredFormat': {
+                    'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9},
+                    'textFormat': {'bold': True},
+                    'horizontalAlignment': 'CENTER'
+                }
+            },
+            'fields': 'userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)'
+        }
+    })
+
+    # Add gradient conditional formatting for numeric columns
+    rules = [sheets_lib.get_gradient_rule(sheet_id, col_idx) for col_idx in range(1, len(df.columns))]
+
+    # Execute formatting requests
+    batch.sync_format_rules(sheet_id, rules, format_requests)
+
+    colors = [
+        {'red': 0.4, 'green': 0.4, 'blue': 1.0},  # Blue
+        {'red': 1.0, 'green': 0.4, 'blue': 0.4},  # Red
+        {'red': 0.4, 'green': 1.0, 'blue': 0.4},  # Green
+        {'red': 1.0, 'green': 0.8, 'blue': 0.2},  # Yellow
+        {'red': 0.8, 'green': 0.4, 'blue': 0.8},  # Purple
+        {'red': 0.4, 'green': 0.8, 'blue': 1.0},  # Light Blue
+        {'red': 1.0, 'green': 0.6, 'blue': 0.4},  # Orange
+        {'red': 0.6, 'green': 0.4, 'blue': 0.2},  # Brown
+        {'red': 0.8, 'green': 0.8, 'blue': 0.4},  # Light Yellow
+        {'red': 0.4, 'green': 0.8, 'blue': 0.6}   # Teal
+    ]
+
+    # Chart of the monthly table
+    chart = {
+        'spec': {
+            'title': 'Top Countries Engagement Over Time',
+            'basicChart': {
+                'chartType': 'LINE',
+                'legendPosition': 'RIGHT_LEGEND',
+                'headerCount': 1,
+                'axis': [
+                    {
+                        'position': 'BOTTOM_AXIS',
+                        'title': 'Month-Year'
+                    },
+                    {
+                        'position': 'LEFT_AXIS',
+                        'title': 'Engaged Sessions'
                     }
-                },
-                'fields': 'userEnteredFormat(backgroundColor,textFormat,horizontalAlignment)'
-            }
-        })
-
-        # Add gradient conditional formatting for numeric columns
-        for col_idx in range(1, len(df.columns)):
-            format_requests.append({
-                'addConditionalFormatRule': {
-                    'rule': {
-                        'ranges': [{
-                            'sheetId': worksheet.id,
-                            'startRowIndex': 1,
-                            'startColumnIndex': col_idx,
-                            'endColumnIndex': col_idx + 1
-                        }],
-                        'gradientRule': {
-                            'minpoint': {
-                                'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404},
-                                'type': 'MIN'
-                            },
-                            'midpoint': {
-                                'color': {'red': 1, 'green': 1, 'blue': 1},
-                                'type': 'PERCENTILE',
-                                'value': '50'
-                            },
-                            'maxpoint': {
-                                'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420},
-                                'type': 'MAX'
-                            }
+                ],
+                'domains': [{
+                    'domain': {
+                        'sourceRange': {
+                            'sources': [{
+                                'sheetId': sheet_id,
+                                'startRowIndex': 0,
+                                'endRowIndex': len(df) + 1,
+                                'startColumnIndex': 0,
+                                'endColumnIndex': 1
+                            }]
                         }
-                    }
-                }
-            })
-
-        # Execute formatting requests
-        format_request = {'requests': format_requests}
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body=format_request
-        ).execute()
-
-        colors = [
-            {'red': 0.4, 'green': 0.4, 'blue': 1.0},  # Blue
-            {'red': 1.0, 'green': 0.4, 'blue': 0.4},  # Red
-            {'red': 0.4, 'green': 1.0, 'blue': 0.4},  # Green
-            {'red': 1.0, 'green': 0.8, 'blue': 0.2},  # Yellow
-            {'red': 0.8, 'green': 0.4, 'blue': 0.8},  # Purple
-            {'red': 0.4, 'green': 0.8, 'blue': 1.0},  # Light Blue
-            {'red': 1.0, 'green': 0.6, 'blue': 0.4},  # Orange
-            {'red': 0.6, 'green': 0.4, 'blue': 0.2},  # Brown
-            {'red': 0.8, 'green': 0.8, 'blue': 0.4},  # Light Yellow
-            {'red': 0.4, 'green': 0.8, 'blue': 0.6}   # Teal
-        ]
-
-        # Add chart
-        chart_request = {
-            'requests': [{
-                'addChart': {
-                    'chart': {
-                        'spec': {
-                            'title': 'Top Countries Engagement Over Time',
-                            'basicChart': {
-                                'chartType': 'LINE',
-                                'legendPosition': 'RIGHT_LEGEND',
-                                'headerCount': 1,
-                                'axis': [
-                                    {
-                                        'position': 'BOTTOM_AXIS',
-                                        'title': 'Month-Year'
-                                    },
-                                    {
-                                        'position': 'LEFT_AXIS',
-                                        'title': 'Engaged Sessions'
-                                    }
-                                ],
-                                'domains': [{
-                                    'domain': {
-                                        'sourceRange': {
-                                            'sources': [{
-                                                'sheetId': worksheet.id,
-                                                'startRowIndex': 0,
-                                                'endRowIndex': len(values),
-                                                'startColumnIndex': 0,
-                                                'endColumnIndex': 1
-                                            }]
-                                        }
-                                    },
-                                    'reversed': True  # This will show old to new dates
-                                }],
-                                'series': [
-                                    {
-                                        'series': {
-                                            'sourceRange': {
-                                                'sources': [{
-                                                    'sheetId': worksheet.id,
-                                                    'startRowIndex': 0,
-                                                    'endRowIndex': len(values),
-                                                    'startColumnIndex': idx + 1,
-                                                    'endColumnIndex': idx + 2
-                                                }]
-                                            }
-                                        },
-                                        'targetAxis': 'LEFT_AXIS',
-                                        'lineStyle': {'width': 2},
-                                        'color': colors[idx % len(colors)]  # Add different colors for each line
-                                    } for idx in range(len(top_countries))
-                                ]
+                    },
+                    'reversed': True  # This will show old to new dates
+                }],
+                'series': [
+                    {
+                        'series': {
+                            'sourceRange': {
+                                'sources': [{
+                                    'sheetId': sheet_id,
+                                    'startRowIndex': 0,
+                                    'endRowIndex': len(df) + 1,
+                                    'startColumnIndex': idx + 1,
+                                    'endColumnIndex': idx + 2
+                                }]
                             }
                         },
-                        'position': {
-                            'overlayPosition': {
-                                'anchorCell': {
-                                    'sheetId': worksheet.id,
-                                    'rowIndex': 0,
-                                    'columnIndex': len(df.columns) + 2  # Position chart after the table with padding
-                                },
-                                'widthPixels': 1200,
-                                'heightPixels': 600
-                            }
-                        }
-                    }
-                }
-            }]
+                        'targetAxis': 'LEFT_AXIS',
+                        'lineStyle': {'width': 2},
+                        'color': colors[idx % len(colors)]  # Add different colors for each line
+                    } for idx in range(len(df.columns) - 2)
+                ]
+            }
+        },
+        'position': {
+            'overlayPosition': {
+                'anchorCell': {
+                    'sheetId': sheet_id,
+                    'rowIndex': 0,
+                    'columnIndex': len(df.columns) + 2  # Position chart after the table with padding
+                },
+                'widthPixels': 1200,
+                'heightPixels': 600
+            }
         }
+    }
 
-        # Execute chart request
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body=chart_request
-        ).execute()
+    # Update the chart in place, adding it on the first run
+    batch.sync_charts(sheet_id, [chart])
 
-    except Exception as e:
-        print(f"Error creating report: {str(e)}")
 
 
 
@@ -363,31 +276,61 @@ def main():
 
     global config_obj
     global client
-    global creds
     global service
+    global batch
     global SHEET_TITLE
     
 
     config_obj = json.load(open("conf/config.%s.json" % (domain)))
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
-    credentials_file = "conf/credentials.%s.json" % (domain)
-    # Initialize the GA4 client
-    client = BetaAnalyticsDataClient()
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
-    service = build('sheets', 'v4', credentials=creds)
+    client, service, gc = client_lib.get_clients(domain, config_obj)
+    # A rerun after a failure picks up where this run stopped
+    checkpoint = retry_lib.get_checkpoint(config_obj, "alldomainstop10countries.%s" % (domain))
+    batch = sheets_lib.SheetsBatch(service, config_obj["sheet_id"], checkpoint)
     SHEET_TITLE = 'Top10Countries'
 
-    create_top_countries_report()
+    collector = ga4_lib.get_collector(client, config_obj, checkpoint)
+    if config_obj.get("ga4", {}).get("engine") == "cube":
+        cube = cube_lib.build_cube(collector, config_obj, report_list=["countries"])
+        df = cube_lib.derive_top_countries(cube, "2023-04-01")
+        monthly_df = cube_lib.derive_top_countries_monthly(cube, "2023-04-01")
+    elif config_obj.get("ga4", {}).get("engine") == "pivot":
+        # GA4 ranks the countries and returns the month x country matrix directly
+        collector.add("top_countries", get_top_countries_request())
+        collector.add("top_countries_monthly", pivot_lib.get_monthly_pivot_request(
+            config_obj["property_id"], "country", "engagedSessions", "2023-04-01"
+        ))
+        responses = collector.run()
+
+        df = create_top_countries_report(responses["top_countries"])
+        monthly_df = pivot_lib.derive_top_countries_monthly(responses["top_countries_monthly"])
+    else:
+        # Send all GA4 requests of this run through batch_run_reports
+        collector.add("top_countries", get_top_countries_request())
+        collector.add("top_countries_monthly_keys", get_top_countries_monthly_keys_request())
+        responses = collector.run()
+
+        # The monthly report only asks for the countries of the first round, if there are any
+        monthly_request = get_top_countries_monthly_request(responses["top_countries_monthly_keys"])
+        if monthly_request is not None:
+            collector.add("top_countries_monthly", monthly_request)
+            responses.update(collector.run())
+
+        df = create_top_countries_report(responses["top_countries"])
+        monthly_df = create_top_countries_report_monthly(
+            responses["top_countries_monthly_keys"], responses.get("top_countries_monthly", RunReportResponse())
+        )
+
+    export_top_countries_report(df)
     print("\n ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
 
     SHEET_TITLE = "Top10Countries_Monthly"
-    create_top_countries_report_monthly()
+    export_top_countries_report_monthly(monthly_df)
     print(" ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
-
-
+    # Send everything written above as one values and one spreadsheets batchUpdate
+    batch.flush()
+    checkpoint.clear()
 
     return
 
@@ -1,20 +1,22 @@
-import os,sys
+import sys
 import json
-import numpy as np
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, OrderBy, MetricType
 import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gspread
 import json_lib
+import ga4_lib
+import client_lib
+import cube_lib
+import path_lib
+import report_lib
+import sheets_lib
+import retry_lib
 from optparse import OptionParser
 
 
 
 
 
-def get_top_pages_overview():
+def get_top_pages_request():
 
     # First get top 20 pages overall with extended date range
     top_pages_request = RunReportRequest(
@@ -33,35 +35,39 @@ def get_top_pages_overview():
         date_ranges=[DateRange(start_date="2023-04-01", end_date="today")]
     )
 
-    top_pages_response = client.run_report(top_pages_request)
-    
-    # In the first path mapping section, replace:
-    path_mapping = {}
-    for row in top_pages_response.rows:
-        path = row.dimension_values[0].value
-        normalized_path = path.rstrip('/')
-        
-        # Handle special cases and duplicates
-        if path == "/" or path == "/home" or path == "/home/":
-            normalized_path = "/"
-        elif path.startswith("/glycan-search"):
-            normalized_path = "/glycan-search/"
-        elif path.startswith("/protein-search"):
-            normalized_path = "/protein-search/"
-            
-        # Add views to get proper top pages
-        views = int(row.metric_values[0].value)
-        if normalized_path not in path_mapping:
-            path_mapping[normalized_path] = {'path': path, 'views': views}
-        else:
-            path_mapping[normalized_path]['views'] += views
-
-    # Sort by total views and get top 20
-    consolidated_paths = [info['path'] for info in sorted(path_mapping.values(), 
-                     key=lambda x: x['views'], reverse=True)][:20]
-
-
-    # Then get monthly data with increased limits
+    return top_pages_request
+
+
+def get_monthly_total_request():
+
+    # Total pageviews of all pages per month
+    total_request = RunReportRequest(
+        property='properties/' + config_obj["property_id"],
+        dimensions=[
+            Dimension(name="year"),
+            Dimension(name="month")
+        ],
+        metrics=[
+            Metric(name="screenPageViews")
+        ],
+        order_bys=[
+            OrderBy(dimension={"dimension_name": "year"}, desc=True),
+            OrderBy(dimension={"dimension_name": "month"}, desc=True)
+        ],
+        date_ranges=[DateRange(start_date="2023-04-01", end_date="today")]
+    )
+
+    return total_request
+
+
+def get_monthly_request(top_pages_response):
+
+    # Then get monthly data for the paths that are counted in the top 20
+    path_filter = normalizer.get_filter(
+        ga4_lib.get_dimension_values(top_pages_response, "pagePath"), get_consolidated_paths(top_pages_response).index
+    )
+    if path_filter is None:
+        return None
     monthly_request = RunReportRequest(
         property='properties/' + config_obj["property_id"],
         dimensions=[
@@ -77,130 +83,82 @@ def get_top_pages_overview():
             OrderBy(dimension={"dimension_name": "month"}, desc=True)
         ],
         date_ranges=[DateRange(start_date="2023-04-01", end_date="today")],
+        dimension_filter=path_filter,
         limit=100000,  # Maximum limit to avoid data sampling
         offset=0  # Start from beginning
     )
 
-    # Get all data by handling pagination
-    all_rows = []
-    while True:
-        response = client.run_report(monthly_request)
-        all_rows.extend(response.rows)
-        
-        if len(response.rows) < 100000:  # No more data to fetch
-            break
-            
-        monthly_request.offset = len(all_rows)  # Update offset for next batch
-
-    # Process into a dictionary with consolidated paths
-    monthly_data = {}
-    total_monthly_views = {}
-
-    # In the monthly data processing section, modify:
-    for row in all_rows:
-        year = int(row.dimension_values[0].value)
-        month = int(row.dimension_values[1].value)
-        page_path = row.dimension_values[2].value
-        views = int(row.metric_values[0].value)
-        
-        month_key = f"{month:02d}, {year}"
-        
-        if month_key not in monthly_data:
-            monthly_data[month_key] = {path: 0 for path in consolidated_paths}
-            total_monthly_views[month_key] = 0
-        
-        # Normalize path and add views
-        normalized_path = page_path.rstrip('/')
-        if normalized_path == "/" or normalized_path == "/home":
-            normalized_path = "/"
-            monthly_data[month_key]["/"] += views
-        elif normalized_path.startswith("/glycan-search"):
-            monthly_data[month_key]["/glycan-search/"] += views
-        elif normalized_path.startswith("/protein-search"):
-            monthly_data[month_key]["/protein-search/"] += views
-        elif page_path in consolidated_paths:
-            monthly_data[month_key][page_path] += views
-        
-        total_monthly_views[month_key] += views
-
-
-    # Create DataFrame and continue with existing code...
-    df = pd.DataFrame.from_dict(monthly_data, orient='index')
-    df['Total Pageviews'] = pd.Series(total_monthly_views)
-    
-    cols = ['Total Pageviews'] + [col for col in df.columns if col != 'Total Pageviews']
-    df = df[cols]
-    
-    df.index.name = 'Month-Year'
-    df = df.reset_index()
+    return monthly_request
+
+
+def get_consolidated_paths(top_pages_response):
+
+    # Handle special cases and duplicates with the domain's path rules
+    df = ga4_lib.decode_response(top_pages_response)
+    df['path'] = df['pagePath'].astype(str)
+    df['normalized_path'] = normalizer.normalize_column(df['path'])
+
+    # Add views to get proper top pages, labelled with the first raw path of each
+    grouped = df.groupby('normalized_path', sort=False)
+    path_mapping = pd.DataFrame({'path': grouped['path'].first(), 'views': grouped['screenPageViews'].sum()})
+
+    # Sort by total views and get top 20, as labels indexed by normalized path
+    return path_mapping.sort_values('views', ascending=False, kind='stable')['path'][:20]
+
+
+def get_top_pages_overview(top_pages_response, monthly_chunks, total_response):
+
+    top_paths = get_consolidated_paths(top_pages_response)
+
+    # The monthly report only holds the top paths, so totals come from their own report
+    total_df = ga4_lib.decode_response(total_response)
+    total_monthly_views = pd.Series(total_df['screenPageViews'].values, index=ga4_lib.get_month_keys(total_df))
+
+    # Aggregate each page of monthly rows as it arrives
+    month_list = list(total_monthly_views.index)
+    views_list = []
+    for df in monthly_chunks:
+        # Normalize paths with the same rules as the ranking, dropping rows outside the top 20
+        df['column'] = normalizer.normalize_column(df['pagePath'].astype(str))
+        df['Month-Year'] = ga4_lib.get_month_keys(df)
+        month_list += df['Month-Year'].unique().tolist()
+        views_list.append(report_lib.get_month_sums(df, 'column', 'screenPageViews', top_paths.index))
+    month_list = list(dict.fromkeys(month_list))
+
+    # Months x pages over every month either report has
+    df = report_lib.get_month_matrix(report_lib.concat_sums(views_list), top_paths.index, month_list)
+    df.columns = top_paths.tolist()
+    df.insert(0, 'Total Pageviews', total_monthly_views.reindex(month_list).fillna(0).astype(int))
 
     # Sort by date (latest first)
-    df['Sort_Date'] = pd.to_datetime(df['Month-Year'], format='%m, %Y')
-    df = df.sort_values('Sort_Date', ascending=False)
-    df = df.drop('Sort_Date', axis=1)
+    return report_lib.format_matrix(df)
+
+
+def export_top_pages_overview(df):
 
-    gc = gspread.authorize(creds)
-    
-    # Convert DataFrame to values
-    values = [df.columns.tolist()] + df.values.tolist()
     
-    # Update sheet
-    sheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-    sheet.clear()
-    sheet.update(values, "A1")
+    sheet_id = batch.get_sheet_id(SHEET_TITLE)
+
+    # Write only the cells that changed
+    table = batch.write_table(SHEET_TITLE, df)
 
     # Apply conditional formatting to all numeric columns
-    format_request = {
-        'requests': [{
-            'addConditionalFormatRule': {
-                'rule': {
-                    'ranges': [{
-                        'sheetId': sheet.id,
-                        'startRowIndex': 1,
-                        'startColumnIndex': col_idx,
-                        'endColumnIndex': col_idx + 1
-                    }],
-                    'gradientRule': {
-                        'minpoint': {'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404}, 'type': 'MIN'},
-                        'midpoint': {'color': {'red': 1, 'green': 1, 'blue': 1}, 'type': 'PERCENTILE', 'value': '50'},
-                        'maxpoint': {'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420}, 'type': 'MAX'}
-                    }
-                }
-            }
-        } for col_idx in range(1, len(df.columns))]
-    }
-    
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body=format_request
-    ).execute()
+    rules = [sheets_lib.get_gradient_rule(sheet_id, col_idx) for col_idx in range(1, len(df.columns))]
+    batch.sync_format_rules(sheet_id, rules)
 
 
-    return
+    return table
 
 
 
 
-def add_top_pages_chart():
+def add_top_pages_chart(table):
     
     
-    # Get sheet ID
-    spreadsheet = service.spreadsheets().get(spreadsheetId=config_obj["sheet_id"]).execute()
-    sheet_id = None
-    for sheet in spreadsheet['sheets']:
-        if sheet['properties']['title'] == SHEET_TITLE:
-            sheet_id = sheet['properties']['sheetId']
-            break
-            
-    if sheet_id is None:
-        raise ValueError(f"Sheet '{SHEET_TITLE}' not found")
-
-    # Get the data to determine dimensions
-    gc = gspread.authorize(creds)
-    worksheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-    data = worksheet.get_all_values()
-    num_rows = len(data)
-    num_columns = len(data[0])
+    # Sheet ID and dimensions of the table just written
+    sheet_id = table.sheet_id
+    num_rows = table.num_rows
+    num_columns = table.num_columns
 
     padding_request = {
         'requests': [{
@@ -237,7 +195,7 @@ def add_top_pages_chart():
     chart_obj = json_lib.get_top_pages_chart_json(sheet_id, num_rows, num_columns)
 
     # Add series for top 10 pages (columns 1 to 11, including Total Pageviews)
-    for idx in range(1, 11):
+    for idx in range(1, min(11, num_columns)):
         series = {
             'series': {
                 'sourceRange': {
@@ -256,23 +214,8 @@ def add_top_pages_chart():
         }
         chart_obj['spec']['basicChart']['series'].append(series)
 
-    # Create the chart request
-    chart_request = {
-        'requests': [{
-            'addChart': {
-                'chart': chart_obj
-            }
-        }]
-    }
-
-    # Execute the request
-    try:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body=chart_request
-        ).execute()
-    except Exception as e:
-        print(f"Error creating chart: {str(e)}")
+    # Update the chart in place, adding it on the first run
+    batch.sync_charts(sheet_id, [chart_obj])
 
     return
 
@@ -300,27 +243,43 @@ def main():
 
     global config_obj
     global client
-    global creds
     global service
+    global batch
     global SHEET_TITLE
+    global normalizer
     
 
     config_obj = json.load(open("conf/config.%s.json" % (domain)))
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
-    credentials_file = "conf/credentials.%s.json" % (domain)
-    # Initialize the GA4 client
-    client = BetaAnalyticsDataClient()
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
-    service = build('sheets', 'v4', credentials=creds)
+    normalizer = path_lib.get_normalizer(config_obj)
+    client, service, gc = client_lib.get_clients(domain, config_obj)
+    # A rerun after a failure picks up where this run stopped
+    checkpoint = retry_lib.get_checkpoint(config_obj, "improvedtop20pages.%s" % (domain))
+    batch = sheets_lib.SheetsBatch(service, config_obj["sheet_id"], checkpoint)
     SHEET_TITLE = 'Improved_Top20Pages'
 
 
-    get_top_pages_overview()
-    add_top_pages_chart()
+    collector = ga4_lib.get_collector(client, config_obj, checkpoint)
+    if config_obj.get("ga4", {}).get("engine") == "cube":
+        cube = cube_lib.build_cube(collector, config_obj, report_list=["pages"])
+        df = cube_lib.derive_top_pages(cube, "2023-04-01", normalizer=normalizer)
+    else:
+        collector.add("top_pages", get_top_pages_request())
+        collector.add("total", get_monthly_total_request())
+        responses = collector.run()
+
+        # The monthly report only asks for the top paths, if there are any, and is streamed page by page
+        monthly_request = get_monthly_request(responses["top_pages"])
+        monthly_chunks = collector.iter_report(monthly_request) if monthly_request is not None else []
+        df = get_top_pages_overview(responses["top_pages"], monthly_chunks, responses["total"])
+
+    table = export_top_pages_overview(df)
+    add_top_pages_chart(table)
     
     print(" ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
+    # Send everything written above as one values and one spreadsheets batchUpdate
+    batch.flush()
+    checkpoint.clear()
 
     return
 
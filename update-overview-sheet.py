@@ -1,18 +1,20 @@
-import os,sys
+import sys
 import json
-import numpy as np
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, OrderBy
 import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gspread
+import ga4_lib
+import client_lib
+import cube_lib
+import channel_lib
+import report_lib
+import sheets_lib
+import retry_lib
 from optparse import OptionParser
 
 
 
 
-def create_glygen_ga4_report():
+def get_glygen_ga4_requests():
     # Main GA4 metrics request
     main_request = RunReportRequest(
         property='properties/' + config_obj["property_id"],
@@ -45,9 +47,8 @@ def create_glygen_ga4_report():
         property='properties/' + config_obj["property_id"],
         dimensions=[
             Dimension(name="year"),
-            Dimension(name="month"),
-            Dimension(name="sessionSource")
-        ],
+            Dimension(name="month")
+        ] + [Dimension(name=field) for field in classifier.fields],
         metrics=[Metric(name="sessions")],
         order_bys=[
             OrderBy(dimension={'dimension_name': 'year'}, desc=True),
@@ -68,60 +69,35 @@ def create_glygen_ga4_report():
         }
     )
 
-    # Send requests
-    main_response = client.run_report(main_request)
-    traffic_source_response = client.run_report(traffic_source_request)
-
-    # Process main metrics
-    def process_glygen_metrics(response):
-        row_headers = [row.dimension_values for row in response.rows]
-        metric_values = [row.metric_values for row in response.rows]
-
-        data = []
-        
-        for i in range(len(row_headers)):
-            year = int(row_headers[i][0].value)
-            month = int(row_headers[i][1].value)
-            total_users = float(metric_values[i][0].value)
-            active_users = float(metric_values[i][1].value)
-            new_users = float(metric_values[i][2].value)
-            returning_users = total_users - new_users
-            hits_events = float(metric_values[i][3].value)
-            sessions = float(metric_values[i][4].value)
+    return main_request, traffic_source_request
 
-            data.append([year, month, total_users, active_users, returning_users, new_users, hits_events, sessions])
 
-        df = pd.DataFrame(data, columns=[
-            "Year", "Month", "Total Users", "Users/Active Users", "Returning Users", "New Users", "Hits/Events", "Sessions"
-        ])
+def create_glygen_ga4_report(main_response, traffic_source_response):
 
-        return df
+    # Process main metrics
+    def process_glygen_metrics(response):
+        df = ga4_lib.decode_response(response)
+        metric_list = ['totalUsers', 'activeUsers', 'newUsers', 'eventCount', 'sessions']
+        df[metric_list] = df[metric_list].astype(float)
+        df['returning_users'] = df['totalUsers'] - df['newUsers']
+        df['Month-Year'] = ga4_lib.get_month_keys(df)
+
+        df = df.rename(columns={
+            'totalUsers': "Total Users", 'activeUsers': "Users/Active Users",
+            'returning_users': "Returning Users", 'newUsers': "New Users", 'eventCount': "Hits/Events",
+            'sessions': "Sessions"
+        })
+
+        return df[[
+            "Month-Year", "Total Users", "Users/Active Users", "Returning Users", "New Users", "Hits/Events", "Sessions"
+        ]]
 
     # Process traffic sources
     def process_glygen_traffic_sources(response):
-        data = {}
-        for row in response.rows:
-            year = int(row.dimension_values[0].value)
-            month = int(row.dimension_values[1].value)
-            source = row.dimension_values[2].value
-            sessions = float(row.metric_values[0].value)
-            
-            key = f"{month:02}, {year}"
-            if key not in data:
-                data[key] = {"Organic Search": 0, "Direct": 0, "Referral": 0}
-            
-            if source.lower() == "google":
-                data[key]["Organic Search"] += sessions
-            elif source.lower() == "(direct)":
-                data[key]["Direct"] += sessions
-            elif source.lower() not in ["google", "(direct)"]:
-                data[key]["Referral"] += sessions
-
-        df = pd.DataFrame.from_dict(data, orient='index', columns=["Organic Search", "Direct", "Referral"])
-        df.index.name = "Month-Year"
-        df = df.reset_index()
-        
-        return df
+        df = ga4_lib.decode_response(response)
+        df['channel'] = classifier.classify(df)
+
+        return report_lib.get_month_table(df, 'channel', 'sessions', classifier.channels, dtype=float).reset_index()
 
     # Process both datasets
     main_df = process_glygen_metrics(main_response)
@@ -129,135 +105,33 @@ def create_glygen_ga4_report():
 
     # Combine datasets
     def combine_datasets(main_df, traffic_sources_df):
-        # Create Month-Year column for both dataframes
-        main_df['Month-Year'] = main_df['Month'].apply(lambda x: f'{x:02}') + ', ' + main_df['Year'].astype(str)
-        
-        # Merge dataframes
+        # Merge dataframes on their period keys
         combined_df = pd.merge(main_df, traffic_sources_df, on='Month-Year', how='left')
         
         # Reorder and select columns
         columns_order = [
             'Month-Year', 'Total Users', 'Users/Active Users', 'Returning Users', 
-            'New Users', 'Hits/Events', 'Sessions', 
-            'Organic Search', 'Direct', 'Referral'
-        ]
+            'New Users', 'Hits/Events', 'Sessions'
+        ] + classifier.channels
         combined_df = combined_df[columns_order]
         
-        # Create a datetime column for sorting
-        combined_df['Sort_Date'] = pd.to_datetime(combined_df['Month-Year'], format='%m, %Y')
-        
         # Sort in descending order (latest first)
-        combined_df = combined_df.sort_values('Sort_Date', ascending=False)
-        
-        # Drop the sorting column
-        combined_df = combined_df.drop(columns=['Sort_Date'])
-        
-        return combined_df
+        return ga4_lib.sort_by_month(combined_df)
 
     return combine_datasets(main_df, traffic_sources_df)
 
-def add_color_formatting(df):
-    """
-    Add color formatting based on trends and outliers
-    Color coding:
-    - Green: Above average (positive trend)
-    - Red: Below average (negative trend)
-    - Yellow: Slightly different from average
-    """
-    def get_color_class(column):
-        # Calculate mean and standard deviation
-        mean = df[column].mean()
-        std = df[column].std()
-        
-        def color_mapper(value):
-            # More than 1 std dev above mean
-            if value > mean + std:
-                return 'positive-high-outlier'
-            # Between 0.5 and 1 std dev above mean
-            elif value > mean + (std/2):
-                return 'positive-mild-outlier'
-            # More than 1 std dev below mean
-            elif value < mean - std:
-                return 'negative-high-outlier'
-            # Between 0.5 and 1 std dev below mean
-            elif value < mean - (std/2):
-                return 'negative-mild-outlier'
-            # Close to average
-            else:
-                return 'average'
-        
-        return df[column].apply(color_mapper)
-    
-    # Columns to analyze (excluding Month-Year)
-    numeric_columns = df.columns.drop('Month-Year').tolist()
-    
-    # Create color mapping for each column
-    color_mapping = {col: get_color_class(col) for col in numeric_columns}
-    
-    return df, color_mapping
-
 # Google Sheets API setup and export
-def export_to_google_sheets(df, color_mapping):
+def export_to_google_sheets(df):
 
-    gc = gspread.authorize(creds)
 
     # Check if sheet exists, if not create it
-    try:
-        sheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-    except gspread.exceptions.WorksheetNotFound:
-        sheet = gc.open_by_key(config_obj["sheet_id"]).add_worksheet(title=SHEET_TITLE, rows="100", cols="20")
-
-    # Convert DataFrame to list of lists for Google Sheets
-    values = [df.columns.tolist()] + df.values.tolist()
-
-    # Update the sheet
-    sheet.clear()  # Clear existing content
-    sheet.update('A1', values, value_input_option='RAW')
-
-    # Update the sheet
-    #request = service.spreadsheets().values().update(
-    #    spreadsheetId=config_obj["sheet_id"],
-    #    range= SHEET_TITLE + '!A1',
-    #    valueInputOption='RAW',
-    #    body={'values': values}
-    #)
-    #response = request.execute()
-
-    # Formatting colors
-    batch_update_requests = [{
-            'addConditionalFormatRule': {
-                'rule': {
-                    'ranges': [{
-                        'sheetId': sheet.id,
-                        'startRowIndex': 1,  # Skip header row
-                        'startColumnIndex': col_idx - 1,
-                        'endColumnIndex': col_idx
-                    }],
-                    'gradientRule': {
-                        'minpoint': {
-                            'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404},  # Red
-                            'type': 'MIN'
-                        },
-                        'midpoint': {
-                            'color': {'red': 1, 'green': 1, 'blue': 1},  # White
-                            'type': 'PERCENTILE',
-                            'value': '50'
-                        },
-                        'maxpoint': {
-                            'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420},  # Green
-                            'type': 'MAX'
-                        }
-                    }
-                }
-            }
-        } for col_idx, col_name in enumerate(df.columns[1:], start=2)]  # Skip first column
+    sheet_id = batch.get_sheet_id(SHEET_TITLE, create=True)
+
+    # Write only the cells that changed
+    batch.write_table(SHEET_TITLE, df)
 
-    # Execute batch update
-    if batch_update_requests:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body={'requests': batch_update_requests}
-        ).execute()
+    # Color each cell by how far it lies from its column's mean, first column skipped
+    batch.sync_cell_colors(sheet_id, sheets_lib.get_outlier_classes(df[df.columns[1:]]))
 
     print(f"Report updated successfully in sheet: {SHEET_TITLE}")
 
@@ -287,20 +161,19 @@ def main():
 
     global config_obj
     global client
-    global creds
     global service
+    global batch
+    global classifier
     global SHEET_TITLE
     global DOMAIN_LIST
  
 
     config_obj = json.load(open("conf/config.%s.json" % (domain)))
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
-    credentials_file = "conf/credentials.%s.json" % (domain)
-    # Initialize the GA4 client
-    client = BetaAnalyticsDataClient()
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
-    service = build('sheets', 'v4', credentials=creds)
+    client, service, gc = client_lib.get_clients(domain, config_obj)
+    classifier = channel_lib.get_classifier(config_obj)
+    # A rerun after a failure picks up where this run stopped
+    checkpoint = retry_lib.get_checkpoint(config_obj, "overview.%s.%s" % (domain, module))
+    batch = sheets_lib.SheetsBatch(service, config_obj["sheet_id"], checkpoint)
 
     SHEET_TITLE = config_obj["tabs"]["overview"][module]["sheet_title"]
     DOMAIN_LIST = config_obj["tabs"]["overview"][module]["domain_list"]
@@ -310,17 +183,28 @@ def main():
     #print (DOMAIN_LIST)
     #exit()
 
-    df = create_glygen_ga4_report()
-    df_with_colors, color_mapping = add_color_formatting(df)
-    export_to_google_sheets(df_with_colors, color_mapping)
-
-    # Optional: Print the first few rows and color mapping
-    print(df_with_colors.head())
+    collector = ga4_lib.get_collector(client, config_obj, checkpoint)
+    if config_obj.get("ga4", {}).get("engine") == "cube":
+        cube = cube_lib.build_cube(collector, config_obj, DOMAIN_LIST, report_list=["module_users", "sources"])
+        df = cube_lib.derive_overview(cube, DOMAIN_LIST, classifier=classifier)
+    else:
+        # Send both GA4 requests in one batch
+        main_request, traffic_source_request = get_glygen_ga4_requests()
+        collector.add("main", main_request)
+        collector.add("traffic_source", traffic_source_request)
+        responses = collector.run()
+        df = create_glygen_ga4_report(responses["main"], responses["traffic_source"])
+    export_to_google_sheets(df)
+
+    # Optional: Print the color mapping
     print("\nColor Mapping Legend:")
     print("- Green shades: Performance above average (light to dark intensity)")
     print("- Red shades: Performance below average (light to dark intensity)")
     print("- White: Performance close to average")
 
+    # Send everything written above as one values and one spreadsheets batchUpdate
+    batch.flush()
+    checkpoint.clear()
 
     return
 
@@ -1,18 +1,19 @@
-import os, sys
+import sys
 import json
 import numpy as np
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, OrderBy, MetricType
 import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gspread
 import json_lib
+import ga4_lib
+import client_lib
+import cube_lib
+import sheets_lib
+import retry_lib
 from optparse import OptionParser
 
 
 
-def explore_subdomains():
+def get_subdomains_request():
 
     # First get all hostnames/subdomains
     hostname_request = RunReportRequest(
@@ -31,38 +32,38 @@ def explore_subdomains():
         date_ranges=[DateRange(start_date="2023-04-01", end_date="today")]
     )
 
-    hostname_response = client.run_report(hostname_request)
+    return hostname_request
+
+
+def explore_subdomains(hostname_response):
 
     # Process into DataFrame
-    data = []
-    for row in hostname_response.rows:
-        hostname = row.dimension_values[0].value
-        pageviews = int(row.metric_values[0].value)
-        sessions = int(row.metric_values[1].value)
-        users = int(row.metric_values[2].value)
-        data.append([hostname, pageviews, sessions, users])
+    df = ga4_lib.decode_response(hostname_response)
+    df = pd.DataFrame({
+        "Hostname": df["hostname"].astype(str),
+        "Pageviews": df["screenPageViews"].astype(int),
+        "Engaged Sessions": df["engagedSessions"].astype(int),
+        "Users": df["totalUsers"].astype(int)
+    })
+
+    return df
+
 
-    df = pd.DataFrame(data, columns=["Hostname", "Pageviews", "Engaged Sessions", "Users"])
+def export_subdomains(df):
 
-    gc = gspread.authorize(creds)
     
 
     # Create or get worksheet
-    try:
-        worksheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-        worksheet.clear()
-    except:
-        worksheet = gc.open_by_key(config_obj["sheet_id"]).add_worksheet(SHEET_TITLE, rows=100, cols=20)
+    sheet_id = batch.get_sheet_id(SHEET_TITLE, create=True)
 
-    # Update values
-    values = [df.columns.tolist()] + df.values.tolist()
-    worksheet.update(values=values, range_name='A1')
+    # Write only the cells that changed
+    batch.write_table(SHEET_TITLE, df)
 
     # Format header
     format_requests = [{
         'repeatCell': {
             'range': {
-                'sheetId': worksheet.id,
+                'sheetId': sheet_id,
                 'startRowIndex': 0,
                 'endRowIndex': 1
             },
@@ -78,41 +79,11 @@ def explore_subdomains():
     }]
 
     # Add conditional formatting for numeric columns
-    for col_idx in range(1, 4):  # Columns B, C, D
-        format_requests.append({
-            'addConditionalFormatRule': {
-                'rule': {
-                    'ranges': [{
-                        'sheetId': worksheet.id,
-                        'startRowIndex': 1,
-                        'startColumnIndex': col_idx,
-                        'endColumnIndex': col_idx + 1
-                    }],
-                    'gradientRule': {
-                        'minpoint': {
-                            'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404},
-                            'type': 'MIN'
-                        },
-                        'midpoint': {
-                            'color': {'red': 1, 'green': 1, 'blue': 1},
-                            'type': 'PERCENTILE',
-                            'value': '50'
-                        },
-                        'maxpoint': {
-                            'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420},
-                            'type': 'MAX'
-                        }
-                    }
-                }
-            }
-        })
+    rules = [sheets_lib.get_gradient_rule(sheet_id, col_idx) for col_idx in range(1, 4)]  # Columns B, C, D
 
-    service.spreadsheets().batchUpdate(
-        spreadsheetId=config_obj["sheet_id"],
-        body={'requests': format_requests}
-    ).execute()
+    batch.sync_format_rules(sheet_id, rules, format_requests)
 
-    return df  # Return DataFrame for further analysis
+    return
 
 
 
@@ -136,28 +107,33 @@ def main():
 
     global config_obj
     global client
-    global creds
     global service
+    global batch
     global SHEET_TITLE
     
 
     config_obj = json.load(open("conf/config.%s.json" % (domain)))
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
-    credentials_file = "conf/credentials.%s.json" % (domain)
-    # Initialize the GA4 client
-    client = BetaAnalyticsDataClient()
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
-    service = build('sheets', 'v4', credentials=creds)
+    client, service, gc = client_lib.get_clients(domain, config_obj)
+    # A rerun after a failure picks up where this run stopped
+    checkpoint = retry_lib.get_checkpoint(config_obj, "subdomainsoverview.%s" % (domain))
+    batch = sheets_lib.SheetsBatch(service, config_obj["sheet_id"], checkpoint)
 
     SHEET_TITLE = 'Subdomains_Overview'
-    subdomains_df = explore_subdomains()
+    collector = ga4_lib.get_collector(client, config_obj, checkpoint)
+    if config_obj.get("ga4", {}).get("engine") == "cube":
+        # Only the per-hostname totals are needed here
+        subdomains_df = cube_lib.derive_subdomains_overview(cube_lib.build_cube(collector, config_obj, report_list=["hosts"]))
+    else:
+        hostname_response = collector.run_report(get_subdomains_request())
+        subdomains_df = explore_subdomains(hostname_response)
+    export_subdomains(subdomains_df)
     print("\n ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
     #print(subdomains_df[['Hostname', 'Pageviews']].to_string())
 
-
-
+    # Send everything written above as one values and one spreadsheets batchUpdate
+    batch.flush()
+    checkpoint.clear()
 
     return
 
@@ -1,62 +1,22 @@
-import os,sys
+import sys
 import json
 
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import (
-    DateRange, Dimension, Metric, RunReportRequest, OrderBy, Filter, FilterExpression, FilterExpressionList
+    DateRange, Dimension, Metric, RunReportRequest, RunReportResponse, RunPivotReportResponse, OrderBy, Filter, FilterExpression, FilterExpressionList
 )
-import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gspread
+import ga4_lib
+import client_lib
+import cube_lib
+import pivot_lib
+import report_lib
+import sheets_lib
+import retry_lib
 from optparse import OptionParser
 
 
 
 
 
-def add_color_formatting(df):
-    """
-    Add color formatting based on trends and outliers
-    Color coding:
-    - Green: Above average (positive trend)
-    - Red: Below average (negative trend)
-    - Yellow: Slightly different from average
-    """
-    def get_color_class(column):
-        # Calculate mean and standard deviation
-        mean = df[column].mean()
-        std = df[column].std()
-
-        def color_mapper(value):
-            # More than 1 std dev above mean
-            if value > mean + std:
-                return 'positive-high-outlier'
-            # Between 0.5 and 1 std dev above mean
-            elif value > mean + (std/2):
-                return 'positive-mild-outlier'
-            # More than 1 std dev below mean
-            elif value < mean - std:
-                return 'negative-high-outlier'
-            # Between 0.5 and 1 std dev below mean
-            elif value < mean - (std/2):
-                return 'negative-mild-outlier'
-            # Close to average
-            else:
-                return 'average'
-
-        return df[column].apply(color_mapper)
-
-    # Columns to analyze (excluding Month-Year)
-    numeric_columns = df.columns.drop('Month-Year').tolist()
-
-    # Create color mapping for each column
-    color_mapping = {col: get_color_class(col) for col in numeric_columns}
-
-    return df, color_mapping
-
-
-
 def get_subdomain_filter():
 
     subdomain_filter = FilterExpression(
@@ -96,8 +56,8 @@ def get_subdomain_filter():
     return subdomain_filter
 
 
-def create_glygen_top_referrals_trend_report():
- 
+def get_glygen_top_referrals_request():
+
     subdomain_filter = get_subdomain_filter()
 
     top_referrals_request = RunReportRequest(
@@ -125,11 +85,18 @@ def create_glygen_top_referrals_trend_report():
         )
     )
 
-    top_referrals_response = client.run_report(top_referrals_request)
-    top_referrals = [(row.dimension_values[0].value, row.dimension_values[1].value) 
-                     for row in top_referrals_response.rows]
+    return top_referrals_request
+
+
+def get_glygen_monthly_request(top_referrals_response):
+
+    # Without referral sources there is nothing to ask GA4 for
+    source_list = ga4_lib.get_dimension_values(top_referrals_response, "sessionSource")
+    if not source_list:
+        return None
+    source_filter = ga4_lib.get_in_list_filter("sessionSource", source_list)
 
-    # Second request: Get monthly data for these referral sources
+    # Second request: Get monthly data for these referral sources only
     monthly_request = RunReportRequest(
         property=f'properties/{config_obj["property_id"]}',
         dimensions=[
@@ -144,105 +111,37 @@ def create_glygen_top_referrals_trend_report():
         ],
         date_ranges=[DateRange(start_date="2023-04-01", end_date="today")],
         limit=50000,
-        dimension_filter=subdomain_filter  # Apply hostname filter
+        dimension_filter=ga4_lib.get_and_filter([get_subdomain_filter(), source_filter])  # Apply hostname filter
     )
 
-    monthly_response = client.run_report(monthly_request)
+    return monthly_request
+
+
+def create_glygen_top_referrals_trend_report(top_referrals_response, monthly_response):
+
+    top_referrals = ga4_lib.get_dimension_values(top_referrals_response, 'sessionSource')
 
-    # Process monthly data
-    monthly_data = {}
-    
     # Create all month-year combinations
-    current_date = pd.Timestamp.now()
-    start_date = pd.Timestamp('2023-04-01')
-    date_range = pd.date_range(start=start_date, end=current_date, freq='M')
-    
-    # Initialize the dictionary with all possible months
-    for date in date_range:
-        month_key = f"{date.month:02d}, {date.year}"
-        monthly_data[month_key] = {referral[0]: 0 for referral in top_referrals}
-
-    # Fill in the actual data
-    for row in monthly_response.rows:
-        year = int(row.dimension_values[0].value)
-        month = int(row.dimension_values[1].value)
-        source = row.dimension_values[2].value
-        sessions = int(row.metric_values[0].value)
-        
-        month_key = f"{month:02d}, {year}"
-        if month_key in monthly_data and source in monthly_data[month_key]:
-            monthly_data[month_key][source] = sessions
-
-    # Create DataFrame
-    df = pd.DataFrame.from_dict(monthly_data, orient='index')
-    df.index.name = 'Month-Year'
-    df = df.reset_index()
-
-    # Sort by date (latest first)
-    df['Sort_Date'] = pd.to_datetime(df['Month-Year'], format='%m, %Y')
-    df = df.sort_values('Sort_Date', ascending=False)
-    df = df.drop('Sort_Date', axis=1)
-
-    # Filter out rows where all numeric columns are 0
-    numeric_columns = df.columns.drop('Month-Year')
-    df = df[~(df[numeric_columns] == 0).all(axis=1)]
-
-    # Apply conditional formatting
-    df_with_colors, color_mapping = add_color_formatting(df)  # Reuse the existing function
+    month_list = ga4_lib.get_calendar_periods('2023-04-01')
+
+    # Lay the monthly sessions out as months x sources, with every possible month
+    df = ga4_lib.decode_response(monthly_response)
+    matrix = report_lib.get_month_table(df, 'sessionSource', 'sessions', top_referrals, month_list)
+
+    # Latest month first, without months that had no sessions from these sources
+    return report_lib.drop_empty_months(report_lib.format_matrix(matrix))
+
 
+def export_glygen_top_referrals_trend_report(df):
 
     # Check if sheet exists, if not, create it
-    gc = gspread.authorize(creds)
-    try:
-        sheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-    except gspread.exceptions.WorksheetNotFound:
-        sheet = gc.open_by_key(config_obj["sheet_id"]).add_worksheet(title=SHEET_TITLE, rows="100", cols="20")
-
-    # Convert DataFrame to values for Google Sheets
-    values = [df_with_colors.columns.tolist()] + df_with_colors.values.tolist()
-
-    # Update the sheet
-    sheet.clear()
-    sheet.update(values, 'A1')
-
-    # Apply color formatting in Google Sheets
-    batch_update_requests = []
-    for col_idx, col_name in enumerate(df_with_colors.columns[1:], start=2):  # Skip first column
-        if col_name in color_mapping:
-            batch_update_requests.append({
-                'addConditionalFormatRule': {
-                    'rule': {
-                        'ranges': [{
-                            'sheetId': sheet.id,
-                            'startRowIndex': 1,  # Skip header row
-                            'startColumnIndex': col_idx - 1,
-                            'endColumnIndex': col_idx
-                        }],
-                        'gradientRule': {
-                            'minpoint': {
-                                'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404},  # Red
-                                'type': 'MIN'
-                            },
-                            'midpoint': {
-                                'color': {'red': 1, 'green': 1, 'blue': 1},  # White
-                                'type': 'PERCENTILE',
-                                'value': '50'
-                            },
-                            'maxpoint': {
-                                'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420},  # Green
-                                'type': 'MAX'
-                            }
-                        }
-                    }
-                }
-            })
-
-    # Execute batch update for conditional formatting
-    if batch_update_requests:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body={'requests': batch_update_requests}
-        ).execute()
+    sheet_id = batch.get_sheet_id(SHEET_TITLE, create=True)
+
+    # Write only the cells that changed
+    batch.write_table(SHEET_TITLE, df)
+
+    # Color each cell by how far it lies from its column's mean, first column skipped
+    batch.sync_cell_colors(sheet_id, sheets_lib.get_outlier_classes(df[df.columns[1:]]))
 
     return
 
@@ -268,9 +167,10 @@ def main():
 
     global config_obj
     global client
-    global creds
     global service
+    global batch
     global SHEET_TITLE
+    global DOMAIN_LIST
     global domain
     global module
 
@@ -280,21 +180,49 @@ def main():
 
 
     config_obj = json.load(open("conf/config.%s.json" % (domain)))
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
-    credentials_file = "conf/credentials.%s.json" % (domain)
-    # Initialize the GA4 client
-    client = BetaAnalyticsDataClient()
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
-    service = build('sheets', 'v4', credentials=creds)
+    client, service, gc = client_lib.get_clients(domain, config_obj)
+    # A rerun after a failure picks up where this run stopped
+    checkpoint = retry_lib.get_checkpoint(config_obj, "top10referrals.%s.%s" % (domain, module))
+    batch = sheets_lib.SheetsBatch(service, config_obj["sheet_id"], checkpoint)
 
     SHEET_TITLE = config_obj["tabs"]["top10referrals"][module]["sheet_title"]
-
-
-
-    create_glygen_top_referrals_trend_report()
+    DOMAIN_LIST = config_obj["tabs"]["top10referrals"][module]["domain_list"]
+
+
+
+    collector = ga4_lib.get_collector(client, config_obj, checkpoint)
+    if config_obj.get("ga4", {}).get("engine") == "cube":
+        cube = cube_lib.build_cube(collector, config_obj, report_list=["sources"])
+        df = cube_lib.derive_top_referrals(cube, "2023-04-01", DOMAIN_LIST)
+    elif config_obj.get("ga4", {}).get("engine") == "pivot":
+        # Sources are ranked on referral sessions, then GA4 returns their month x source matrix
+        top_referrals_response = collector.run_report(get_glygen_top_referrals_request())
+        source_list = ga4_lib.get_dimension_values(top_referrals_response, "sessionSource")
+        pivot_response = RunPivotReportResponse()
+        if source_list:
+            pivot_request = pivot_lib.get_monthly_pivot_request(
+                config_obj["property_id"], "sessionSource", "sessions", "2023-04-01", key_limit=len(source_list),
+                dimension_filter=ga4_lib.get_and_filter([get_subdomain_filter(), ga4_lib.get_in_list_filter("sessionSource", source_list)])
+            )
+            pivot_response = collector.run_report(pivot_request)
+        df = pivot_lib.derive_top_referrals(pivot_response, "2023-04-01", source_list)
+    else:
+        collector.add("top_referrals", get_glygen_top_referrals_request())
+        responses = collector.run()
+
+        # The monthly report only asks for the sources of the first round, if there are any
+        monthly_request = get_glygen_monthly_request(responses["top_referrals"])
+        if monthly_request is not None:
+            collector.add("monthly", monthly_request)
+            responses.update(collector.run())
+        df = create_glygen_top_referrals_trend_report(responses["top_referrals"], responses.get("monthly", RunReportResponse()))
+
+    export_glygen_top_referrals_trend_report(df)
     print("\n ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
+    # Send everything written above as one values and one spreadsheets batchUpdate
+    batch.flush()
+    checkpoint.clear()
 
     return
 
@@ -1,59 +1,21 @@
-import os,sys
+import sys
 import json
 
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import (
     DateRange, Dimension, Metric, RunReportRequest, OrderBy, Filter, FilterExpression, FilterExpressionList
 )
 import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-import gspread
+import ga4_lib
+import client_lib
+import cube_lib
+import path_lib
+import report_lib
+import sheets_lib
+import retry_lib
 from optparse import OptionParser
 
 
 
-def add_color_formatting(df):
-    """
-    Add color formatting based on trends and outliers
-    Color coding:
-    - Green: Above average (positive trend)
-    - Red: Below average (negative trend)
-    - Yellow: Slightly different from average
-    """
-    def get_color_class(column):
-        # Calculate mean and standard deviation
-        mean = df[column].mean()
-        std = df[column].std()
-
-        def color_mapper(value):
-            # More than 1 std dev above mean
-            if value > mean + std:
-                return 'positive-high-outlier'
-            # Between 0.5 and 1 std dev above mean
-            elif value > mean + (std/2):
-                return 'positive-mild-outlier'
-            # More than 1 std dev below mean
-            elif value < mean - std:
-                return 'negative-high-outlier'
-            # Between 0.5 and 1 std dev below mean
-            elif value < mean - (std/2):
-                return 'negative-mild-outlier'
-            # Close to average
-            else:
-                return 'average'
-
-        return df[column].apply(color_mapper)
-
-    # Columns to analyze (excluding Month-Year)
-    numeric_columns = df.columns.drop('Month-Year').tolist()
-
-    # Create color mapping for each column
-    color_mapping = {col: get_color_class(col) for col in numeric_columns}
-
-    return df, color_mapping
-
-
 def get_subdomain_filter():
 
     subdomain_filter = FilterExpression(
@@ -98,7 +60,7 @@ def get_subdomain_filter():
 
 
 
-def get_glygen_top_pages_overview():
+def get_glygen_top_pages_request():
 
     subdomain_filter = get_subdomain_filter()
 
@@ -115,31 +77,38 @@ def get_glygen_top_pages_overview():
         dimension_filter=subdomain_filter  # Apply hostname filter
     )
 
-    top_pages_response = client.run_report(top_pages_request)
+    return top_pages_request
 
-    # Process path mapping
-    path_mapping = {}
-    for row in top_pages_response.rows:
-        path = row.dimension_values[0].value
-        normalized_path = path.rstrip('/')
 
-        # Handle special cases and duplicates
-        if path in ["/", "/home", "/home/"]:
-            normalized_path = "/"
-        elif path.startswith("/glycan-search"):
-            normalized_path = "/glycan-search/"
-        elif path.startswith("/protein-search"):
-            normalized_path = "/protein-search/"
+def get_glygen_monthly_total_request():
+
+    # Total pageviews of all pages per month
+    total_request = RunReportRequest(
+        property=f'properties/' + config_obj["property_id"],
+        dimensions=[
+            Dimension(name="year"),
+            Dimension(name="month")
+        ],
+        metrics=[Metric(name="screenPageViews")],
+        order_bys=[
+            OrderBy(dimension={"dimension_name": "year"}, desc=True),
+            OrderBy(dimension={"dimension_name": "month"}, desc=True)
+        ],
+        date_ranges=[DateRange(start_date="2023-04-01", end_date="today")],
+        dimension_filter=get_subdomain_filter()  # Apply hostname filter
+    )
+
+    return total_request
 
-        # Add views to get proper top pages
-        views = int(row.metric_values[0].value)
-        if normalized_path not in path_mapping:
-            path_mapping[normalized_path] = {'path': path, 'views': views}
-        else:
-            path_mapping[normalized_path]['views'] += views
 
-    # Sort by total views and get top 20
-    consolidated_paths = [info['path'] for info in sorted(path_mapping.values(), key=lambda x: x['views'], reverse=True)][:20]
+def get_glygen_monthly_request(top_pages_response):
+
+    # Only the paths that are counted in the top 20
+    path_filter = normalizer.get_filter(
+        ga4_lib.get_dimension_values(top_pages_response, "pagePath"), get_glygen_consolidated_paths(top_pages_response).index
+    )
+    if path_filter is None:
+        return None
 
     # Second request: Get monthly data for these top pages
     monthly_request = RunReportRequest(
@@ -157,127 +126,77 @@ def get_glygen_top_pages_overview():
         date_ranges=[DateRange(start_date="2023-04-01", end_date="today")],
         limit=100000,
         offset=0,
-        dimension_filter=subdomain_filter  # Apply hostname filter
+        dimension_filter=ga4_lib.get_and_filter([get_subdomain_filter(), path_filter])  # Apply hostname filter
     )
 
-    # Get all data by handling pagination
-    all_rows = []
-    while True:
-        response = client.run_report(monthly_request)
-        all_rows.extend(response.rows)
-        if len(response.rows) < 100000:
-            break
-        monthly_request.offset = len(all_rows)
-
-    # Process monthly data
-    monthly_data = {}
-    total_monthly_views = {}
-
-    for row in all_rows:
-        year = int(row.dimension_values[0].value)
-        month = int(row.dimension_values[1].value)
-        page_path = row.dimension_values[2].value
-        views = int(row.metric_values[0].value)
-
-        month_key = f"{month:02d}, {year}"
-
-        if month_key not in monthly_data:
-            monthly_data[month_key] = {path: 0 for path in consolidated_paths}
-            total_monthly_views[month_key] = 0
-
-        # Normalize path and add views
-        normalized_path = page_path.rstrip('/')
-        if normalized_path in ["/", "/home"]:
-            normalized_path = "/"
-            monthly_data[month_key]["/"] += views
-        elif normalized_path.startswith("/glycan-search"):
-            monthly_data[month_key]["/glycan-search/"] += views
-        elif normalized_path.startswith("/protein-search"):
-            monthly_data[month_key]["/protein-search/"] += views
-        elif page_path in consolidated_paths:
-            monthly_data[month_key][page_path] += views
-
-        total_monthly_views[month_key] += views
-
-    # Create DataFrame
-    df = pd.DataFrame.from_dict(monthly_data, orient='index')
-    df['Total Pageviews'] = pd.Series(total_monthly_views)
-    df.index.name = 'Month-Year'
-    df = df.reset_index()
+    return monthly_request
+
+
+def get_glygen_consolidated_paths(top_pages_response):
+
+    # Handle special cases and duplicates with the domain's path rules
+    df = ga4_lib.decode_response(top_pages_response)
+    df['path'] = df['pagePath'].astype(str)
+    df['normalized_path'] = normalizer.normalize_column(df['path'])
+
+    # Add views to get proper top pages, labelled with the first raw path of each
+    grouped = df.groupby('normalized_path', sort=False)
+    path_mapping = pd.DataFrame({'path': grouped['path'].first(), 'views': grouped['screenPageViews'].sum()})
+
+    # Sort by total views and get top 20, as labels indexed by normalized path
+    return path_mapping.sort_values('views', ascending=False, kind='stable')['path'][:20]
+
+
+def get_glygen_top_pages_overview(top_pages_response, monthly_chunks, total_response):
+
+    top_paths = get_glygen_consolidated_paths(top_pages_response)
+
+    # The monthly report only holds the top paths, so totals come from their own report
+    total_df = ga4_lib.decode_response(total_response)
+    total_monthly_views = pd.Series(total_df['screenPageViews'].values, index=ga4_lib.get_month_keys(total_df))
+
+    # Aggregate each page of monthly rows as it arrives
+    month_list = list(total_monthly_views.index)
+    views_list = []
+    for df in monthly_chunks:
+        # Normalize paths with the same rules as the ranking, dropping rows outside the top 20
+        df['column'] = normalizer.normalize_column(df['pagePath'].astype(str))
+        df['Month-Year'] = ga4_lib.get_month_keys(df)
+        month_list += df['Month-Year'].unique().tolist()
+        views_list.append(report_lib.get_month_sums(df, 'column', 'screenPageViews', top_paths.index))
+    month_list = list(dict.fromkeys(month_list))
+
+    # Months x pages over every month either report has
+    df = report_lib.get_month_matrix(report_lib.concat_sums(views_list), top_paths.index, month_list)
+    df.columns = top_paths.tolist()
+    df['Total Pageviews'] = total_monthly_views.reindex(month_list).fillna(0).astype(int)
 
     # Sort by date
-    df['Sort_Date'] = pd.to_datetime(df['Month-Year'], format='%m, %Y')
-    df = df.sort_values('Sort_Date', ascending=False)
-    df = df.drop('Sort_Date', axis=1)
-
-    # Apply conditional formatting
-    df_with_colors, color_mapping = add_color_formatting(df)  # Reuse function
-
-    # Export to Google Sheets
-    gc = gspread.authorize(creds)
-
-
-    try:
-        sheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-    except gspread.exceptions.WorksheetNotFound:
-        sheet = gc.open_by_key(config_obj["sheet_id"]).add_worksheet(title=SHEET_TITLE, rows="100", cols="20")
-
-    # Convert DataFrame to values
-    values = [df_with_colors.columns.tolist()] + df_with_colors.values.tolist()
-
-    # Update sheet
-    sheet.clear()
-    sheet.update(values, "A1")
-
-    # Apply color formatting in Google Sheets
-    batch_update_requests = []
-    for col_idx, col_name in enumerate(df_with_colors.columns[1:], start=2):  # Skip first column
-        if col_name in color_mapping:
-            batch_update_requests.append({
-                'addConditionalFormatRule': {
-                    'rule': {
-                        'ranges': [{
-                            'sheetId': sheet.id,
-                            'startRowIndex': 1,
-                            'startColumnIndex': col_idx - 1,
-                            'endColumnIndex': col_idx
-                        }],
-                        'gradientRule': {
-                            'minpoint': {'color': {'red': 0.839, 'green': 0.404, 'blue': 0.404}, 'type': 'MIN'},
-                            'midpoint': {'color': {'red': 1, 'green': 1, 'blue': 1}, 'type': 'PERCENTILE', 'value': '50'},
-                            'maxpoint': {'color': {'red': 0.420, 'green': 0.655, 'blue': 0.420}, 'type': 'MAX'}
-                        }
-                    }
-                }
-            })
+    return report_lib.format_matrix(df)
+
+
+def export_glygen_top_pages_overview(df):
+
+    sheet_id = batch.get_sheet_id(SHEET_TITLE, create=True)
 
-    if batch_update_requests:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body={'requests': batch_update_requests}
-        ).execute()
+    # Write only the cells that changed
+    table = batch.write_table(SHEET_TITLE, df)
 
+    # Color each cell by how far it lies from its column's mean, first column skipped
+    batch.sync_cell_colors(sheet_id, sheets_lib.get_outlier_classes(df[df.columns[1:]]))
 
+    return table
 
-def add_top_glygen_pages_chart():
+
+
+
+def add_top_glygen_pages_chart(table):
 
     
-    spreadsheet = service.spreadsheets().get(spreadsheetId=config_obj["sheet_id"]).execute()
-    sheet_id = None
-    for sheet in spreadsheet['sheets']:
-        if sheet['properties']['title'] == SHEET_TITLE:
-            sheet_id = sheet['properties']['sheetId']
-            break
-
-    if sheet_id is None:
-        raise ValueError(f"Sheet '{SHEET_TITLE}' not found")
-
-    # Get the data to determine dimensions
-    gc = gspread.authorize(creds)
-    worksheet = gc.open_by_key(config_obj["sheet_id"]).worksheet(SHEET_TITLE)
-    data = worksheet.get_all_values()
-    num_rows = len(data)
-    num_columns = len(data[0])
+    # Sheet ID and dimensions of the table just written
+    sheet_id = table.sheet_id
+    num_rows = table.num_rows
+    num_columns = table.num_columns
 
     # Adjust column width for better visualization
     padding_request = {
@@ -360,7 +279,7 @@ def add_top_glygen_pages_chart():
     }
 
     # Add series for the top 10 pages (columns 1 to 11, including Total Pageviews)
-    for idx in range(1, 11):
+    for idx in range(1, min(11, num_columns)):
         series = {
             'series': {
                 'sourceRange': {
@@ -379,23 +298,8 @@ def add_top_glygen_pages_chart():
         }
         chart['spec']['basicChart']['series'].append(series)
 
-    # Create the chart request
-    chart_request = {
-        'requests': [{
-            'addChart': {
-                'chart': chart
-            }
-        }]
-    }
-
-    # Execute the request
-    try:
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=config_obj["sheet_id"],
-            body=chart_request
-        ).execute()
-    except Exception as e:
-        print(f"Error creating chart: {str(e)}")
+    # Update the chart in place, adding it on the first run
+    batch.sync_charts(sheet_id, [chart])
 
     return
 
@@ -422,9 +326,11 @@ def main():
 
     global config_obj
     global client
-    global creds
     global service
+    global batch
     global SHEET_TITLE
+    global normalizer
+    global DOMAIN_LIST
     global domain
     global module
 
@@ -434,23 +340,40 @@ def main():
     
 
     config_obj = json.load(open("conf/config.%s.json" % (domain)))
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = "conf/credentials.%s.json" % (domain)
-    credentials_file = "conf/credentials.%s.json" % (domain)
-    # Initialize the GA4 client
-    client = BetaAnalyticsDataClient()
-    scopes = ['https://www.googleapis.com/auth/spreadsheets']
-    creds = service_account.Credentials.from_service_account_file(credentials_file, scopes=scopes)
-    service = build('sheets', 'v4', credentials=creds)
+    normalizer = path_lib.get_normalizer(config_obj)
+    client, service, gc = client_lib.get_clients(domain, config_obj)
+    # A rerun after a failure picks up where this run stopped
+    checkpoint = retry_lib.get_checkpoint(config_obj, "top20pages.%s.%s" % (domain, module))
+    batch = sheets_lib.SheetsBatch(service, config_obj["sheet_id"], checkpoint)
 
     SHEET_TITLE = config_obj["tabs"]["top20pages"][module]["sheet_title"]
+    DOMAIN_LIST = config_obj["tabs"]["top20pages"][module]["domain_list"]
+
 
+    collector = ga4_lib.get_collector(client, config_obj, checkpoint)
+    if config_obj.get("ga4", {}).get("engine") == "cube":
+        cube = cube_lib.build_cube(collector, config_obj, report_list=["pages"])
+        df = cube_lib.derive_top_pages(cube, "2023-04-01", DOMAIN_LIST, total_first=False, normalizer=normalizer)
+    else:
+        collector.add("top_pages", get_glygen_top_pages_request())
+        collector.add("total", get_glygen_monthly_total_request())
+        responses = collector.run()
 
-    get_glygen_top_pages_overview()
+        # The monthly report only asks for the top paths, if there are any, and is streamed page by page
+        monthly_request = get_glygen_monthly_request(responses["top_pages"])
+        monthly_chunks = collector.iter_report(monthly_request) if monthly_request is not None else []
+        df = get_glygen_top_pages_overview(responses["top_pages"], monthly_chunks, responses["total"])
+
+    table = export_glygen_top_pages_overview(df)
     print("\n ... FINISHED UPDATING sheet=%s" % (SHEET_TITLE))
 
-    add_top_glygen_pages_chart()
+    add_top_glygen_pages_chart(table)
     print(" ... FINISHED UPDATING CHART sheet=%s" % (SHEET_TITLE))
 
+    # Send everything written above as one values and one spreadsheets batchUpdate
+    batch.flush()
+    checkpoint.clear()
+
     return
 
 